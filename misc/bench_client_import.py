@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+# Compare the import time and memory footprint of prometheus_api_client with the built-in KAPELPrometheus client.
+# Each import is measured in a fresh interpreter. Run it with both installed, e.g. pip install prometheus-api-client
+# Usage: python misc/bench_client_import.py [repetitions]
+
+import os
+import subprocess
+import sys
+
+PYTHON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python')
+
+MEASURE = '''
+import resource, sys, time
+sys.path.insert(0, {path!r})
+t1 = time.perf_counter()
+{statement}
+t2 = time.perf_counter()
+print(t2 - t1, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(sys.modules))
+'''
+
+def measure(statement, repetitions):
+    samples = []
+    for _ in range(repetitions):
+        result = subprocess.run([sys.executable, '-c', MEASURE.format(path=PYTHON_DIR, statement=statement)],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        seconds, rss, n_modules = result.stdout.split()
+        samples.append((float(seconds), int(rss), int(n_modules)))
+    # report the fastest run, which is least affected by other activity
+    return min(samples)
+
+if __name__ == "__main__":
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for module, statement in (('prometheus_api_client', 'from prometheus_api_client import PrometheusConnect'),
+                              ('KAPELPrometheus', 'from KAPELPrometheus import PrometheusClient')):
+        result = measure(statement, repetitions)
+        if result is None:
+            print(f'{module:>22}: not installed')
+        else:
+            print(f'{module:>22}: import {result[0]:.3f} s, peak RSS {result[1]} K, {result[2]} modules loaded')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Benchmark of the separate queries (QueryLogic) against the fused query (FusedQueryLogic) on a real Prometheus server
+# loaded with synthetic kube-state-metrics and cAdvisor data.
+#
+# 1. Generate the synthetic data in OpenMetrics format and convert it to TSDB blocks:
+#      python misc/bench_fusion.py generate --pods 10000 --days 31 > bench.om
+#      promtool tsdb create-blocks-from openmetrics bench.om ./bench-data
+# 2. Start Prometheus on the blocks (an empty scrape config is fine), e.g.
+#      echo 'global: {}' > bench.yml
+#      prometheus --config.file=bench.yml --storage.tsdb.path=./bench-data --storage.tsdb.retention.time=10y
+# 3. Run both query plans over the whole generated period and compare:
+#      python misc/bench_fusion.py run --url http://localhost:9090 --days 31
+#
+# The run reports the wall time of each plan, and the number of samples Prometheus had to load (from the query stats).
+
+import argparse
+import datetime
+import os
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+# Start of the synthetic data, 2023-11-01T00:00:00Z
+BASE_TIME = 1698796800
+NAMESPACE = 'bench'
+# Completed pods remain on the cluster (and in KSM metrics) for this long after they finish
+LINGER_SEC = 86400
+
+def pod(i, days):
+    start = BASE_TIME + (i * 7919) % (days * 86400)
+    end = start + 60 + (i * 104729) % 86400
+    cores = 1 << (i % 4)
+    return f'job-{i:08d}', start, end, cores
+
+# Write OpenMetrics text with one series per pod (per container for cAdvisor) and metric, sampled every 'step' seconds
+# while the pod exists. Samples of each metric family must be contiguous, so write the families one at a time.
+def generate(n_pods, days, step, out):
+    families = [
+        ('kube_pod_start_time', 'gauge', None),
+        ('kube_pod_completion_time', 'gauge', None),
+        ('kube_pod_container_resource_requests', 'gauge', None),
+        ('container_cpu_usage_seconds', 'counter', '_total'),
+    ]
+    for family, metric_type, suffix in families:
+        out.write(f'# TYPE {family} {metric_type}\n')
+        for i in range(n_pods):
+            name, start, end, cores = pod(i, days)
+            labels = f'namespace="{NAMESPACE}",pod="{name}",uid="uid-{i}"'
+            first = start - start % step + step
+            for t in range(first, end + LINGER_SEC, step):
+                if family == 'kube_pod_start_time':
+                    out.write(f'{family}{{{labels}}} {start} {t}\n')
+                elif family == 'kube_pod_completion_time':
+                    if t >= end:
+                        out.write(f'{family}{{{labels}}} {end} {t}\n')
+                elif family == 'kube_pod_container_resource_requests':
+                    out.write(f'{family}{{{labels},container="main",node="node-{i % 100}",resource="cpu",unit="core"}} {cores} {t}\n')
+                    out.write(f'{family}{{{labels},container="main",node="node-{i % 100}",resource="memory",unit="byte"}} {cores * 2000000000} {t}\n')
+                elif t <= end:
+                    out.write(f'{family}{suffix}{{{labels},container="main"}} {(t - start) * cores * 0.9} {t}\n')
+    out.write('# EOF\n')
+
+def run_plan(prom, queries, params):
+    samples = 0
+    t1 = timer()
+    for query_name, query_string in vars(queries).items():
+        response = prom.session.get(f'{prom.url}/api/v1/query', params={'query': query_string, 'stats': 'all', **params})
+        response.raise_for_status()
+        body = response.json()
+        samples += body['data'].get('stats', {}).get('samples', {}).get('totalQueryableSamples', 0)
+    return timer() - t1, samples
+
+def run(url, days, repetitions):
+    from KAPEL import FusedQueryLogic, QueryLogic
+    from KAPELPrometheus import PrometheusClient
+    prom = PrometheusClient(url)
+    instant = datetime.datetime.fromtimestamp(BASE_TIME + days * 86400, tz=datetime.timezone.utc)
+    params = {'time': instant.isoformat(), 'timeout': '1800s'}
+    query_range = f'{days * 86400}s'
+    for label, queries in (('separate', QueryLogic(query_range, [NAMESPACE])), ('fused', FusedQueryLogic(query_range, [NAMESPACE]))):
+        results = [run_plan(prom, queries, params) for _ in range(repetitions)]
+        seconds = min(result[0] for result in results)
+        print(f'{label:>8}: {len(vars(queries))} queries, {seconds:.2f} s (best of {repetitions}), {results[0][1]} samples loaded')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark separate and fused KAPEL queries on synthetic Prometheus data.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    gen = subparsers.add_parser('generate', help='write synthetic OpenMetrics data to stdout')
+    gen.add_argument('--pods', type=int, default=10000)
+    gen.add_argument('--days', type=int, default=31)
+    gen.add_argument('--step', type=int, default=300, help='scrape interval in seconds')
+    bench = subparsers.add_parser('run', help='run both query plans against a Prometheus server')
+    bench.add_argument('--url', default='http://localhost:9090')
+    bench.add_argument('--days', type=int, default=31)
+    bench.add_argument('--repetitions', type=int, default=3)
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args.pods, args.days, args.step, sys.stdout)
+    else:
+        run(args.url, args.days, args.repetitions)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+# Benchmark for writing individual job records to the output message queue.
+# Compares the original one-message-per-record path (with every record echoed to stdout)
+# against batched messages with RECORDS_PER_MESSAGE records each.
+# Usage: python misc/bench_writer.py [n_records] [records_per_message]
+
+import contextlib
+import os
+import sys
+import tempfile
+from timeit import default_timer as timer
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+from KAPEL import INDIVIDUAL_HEADER, RecordWriter, individual_record
+
+def make_config():
+    return SimpleNamespace(site_name='EXAMPLE-T2', vo_name='atlas', submit_host='k8s.example.org:6443/namespace',
+                           infrastructure_type='grid', nodecount=0)
+
+def tree_size(path):
+    files = 0
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+def run(n_records, batch_size, echo):
+    config = make_config()
+    with tempfile.TemporaryDirectory() as output_path:
+        t1 = timer()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            writer = RecordWriter(output_path, INDIVIDUAL_HEADER, batch_size=batch_size, echo=echo)
+            for i in range(n_records):
+                writer.add(individual_record(config, f'pod-{i:08d}', 2048000.0, 8.0, 3600.0, 25000.0,
+                                             1700000000.0 + i, 1700003600.0 + i))
+            writer.flush()
+        t2 = timer()
+        files, size = tree_size(output_path)
+    return files, size, t2 - t1
+
+if __name__ == "__main__":
+    n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    print(f'Writing {n_records} individual records.')
+    for label, size, echo in [('per-record, echoed', 1, True), (f'batched x{batch_size}', batch_size, False)]:
+        files, nbytes, seconds = run(n_records, size, echo)
+        print(f'{label:>20}: {files} files, {nbytes} bytes, {seconds:.3f} s')
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# End-to-end benchmark of the KAPEL processor against the fake Prometheus server (misc/fake_prometheus.py).
+# For each number of pods and each record type (summary and individual), process_period queries the synthetic data for one
+# period covering all of it and writes the records (via record_summarized_period or record_individual_period) to a temporary
+# output path. Each run is a separate process, so that its peak RSS is its own, and the fake server runs in another process,
+# so that generating the responses doesn't compete with KAPEL for the GIL.
+# Reported per scenario: wall time (best of --repeat runs), the time of the query and records phases, peak RSS,
+# the number of queries and response bytes, and the number of output files, records and bytes.
+#
+# The synthetic data is deterministic, so output counts must be identical between runs and the timings are comparable as long
+# as the machine is. Save the results with --output and compare later runs against them with --baseline, which fails if any
+# output differs, or the wall time or peak RSS of a scenario is more than --tolerance (a fraction) worse.
+#
+# Usage: python misc/benchmark.py [--pods 10000,100000,500000] [--extra-labels 20] [--repeat 3] [--env KEY=VALUE ...]
+#                                 [--output results.json] [--baseline results.json]
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from timeit import default_timer as timer
+
+from check_harness import BASE_ENV, PERIOD
+
+MISC = os.path.dirname(os.path.abspath(__file__))
+
+# Configuration of every run: that of the checks, with the queries run serially, which --env can override or add to.
+RUN_ENV = {**BASE_ENV, 'QUERY_CONCURRENCY': '1', 'RECORDS_PER_MESSAGE': '1000'}
+
+# Run one scenario in this process and print its measurements as JSON.
+def child(url, summarize, env):
+    import contextlib
+    import io
+    import KAPEL
+    from KAPELConfig import KAPELConfig
+    from KAPELMetrics import RunReport
+
+    with tempfile.TemporaryDirectory() as output_path:
+        os.environ.update(RUN_ENV, PROMETHEUS_SERVER=url, OUTPUT_PATH=output_path, SUMMARIZE_RECORDS=str(summarize), **env)
+        config = KAPELConfig()
+        prom = KAPEL.connect_prometheus(config)
+        report = RunReport().period(PERIOD)
+        t1 = timer()
+        with contextlib.redirect_stdout(io.StringIO()):
+            n_records = KAPEL.process_period(config, PERIOD, prom, report=report)
+        seconds = timer() - t1
+        files = [path for path in Path(output_path).glob('[0-9a-f]*/*') if path.is_file()]
+        result = report.to_dict()
+        print(json.dumps({
+            'seconds': seconds,
+            'query_seconds': result['phases']['query']['seconds'],
+            'records_seconds': result['phases']['records']['seconds'],
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'queries': len(result['queries']),
+            'query_bytes': sum(q['bytes'] for q in result['queries']),
+            'records': n_records,
+            'files': len(files),
+            'output_bytes': sum(path.stat().st_size for path in files),
+        }))
+
+# Start the fake Prometheus server in a separate process and return (process, URL).
+def start_server(n_pods, extra_labels):
+    process = subprocess.Popen([sys.executable, os.path.join(MISC, 'fake_prometheus.py'), str(n_pods), '0', '--extra-labels', str(extra_labels)],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    return process, line.split()[-1]
+
+def run_scenario(url, summarize, env, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, __file__, '--child', url, str(summarize), json.dumps(env)],
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    # Output counts must not vary between runs of the same scenario
+    for key in ('queries', 'query_bytes', 'records', 'files', 'output_bytes'):
+        assert len({run[key] for run in runs}) == 1, f'{key} differs between runs: {[run[key] for run in runs]}'
+    best = min(runs, key=lambda run: run['seconds'])
+    best['peak_rss_bytes'] = min(run['peak_rss_bytes'] for run in runs)
+    return best
+
+# Compare results with a baseline, returning a list of regressions.
+def compare(results, baseline, tolerance):
+    problems = []
+    for name, result in results['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        for key in ('records', 'files', 'output_bytes'):
+            if result[key] != base[key]:
+                problems.append(f'{name}: {key} is {result[key]}, baseline {base[key]}')
+        for key in ('seconds', 'peak_rss_bytes'):
+            if result[key] > base[key] * (1 + tolerance):
+                problems.append(f'{name}: {key} is {result[key]:.6g}, baseline {base[key]:.6g} (+{result[key] / base[key] - 1:.0%})')
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the KAPEL processor end to end against a fake Prometheus server.")
+    parser.add_argument('--pods', default='10000,100000', help='comma-separated numbers of pods')
+    parser.add_argument('--extra-labels', type=int, default=20, help='number of additional labels on each series')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario; the best is reported')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='additional KAPEL configuration')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed fractional increase of time and RSS over the baseline')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        url, summarize, env = args.child
+        child(url, summarize == 'True', json.loads(env))
+        return
+
+    env = dict(kv.split('=', 1) for kv in args.env)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'extra_labels': args.extra_labels,
+        'env': {**RUN_ENV, **env},
+        'scenarios': {},
+    }
+    print(f"{'scenario':<24} {'seconds':>9} {'query s':>9} {'records s':>9} {'peak RSS MB':>11} {'queries':>7} {'query MB':>9} "
+          f"{'records':>8} {'files':>6} {'output MB':>9}")
+    for n_pods in (int(n) for n in args.pods.split(',')):
+        server, url = start_server(n_pods, args.extra_labels)
+        try:
+            for summarize in (True, False):
+                name = f"{n_pods}-{'summary' if summarize else 'individual'}"
+                r = results['scenarios'][name] = run_scenario(url, summarize, env, args.repeat)
+                print(f"{name:<24} {r['seconds']:>9.2f} {r['query_seconds']:>9.2f} {r['records_seconds']:>9.2f} "
+                      f"{r['peak_rss_bytes'] / 2**20:>11.1f} {r['queries']:>7} {r['query_bytes'] / 2**20:>9.1f} "
+                      f"{r['records']:>8} {r['files']:>6} {r['output_bytes'] / 2**20:>9.2f}", flush=True)
+        finally:
+            server.terminate()
+            server.wait()
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=1))
+    if args.baseline:
+        problems = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for problem in problems:
+            print(f'REGRESSION: {problem}')
+        if problems:
+            sys.exit(1)
+        print('No regressions compared to the baseline.')
+
+if __name__ == "__main__":
+    main()
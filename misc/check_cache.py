@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+# Check that processing a period incrementally with the cache (CACHE_ENABLED), in runs every few days that each query only the time
+# since the previous checkpoint, gives the same records as processing the whole period at once, using the fake Prometheus server with
+# pods whose containers end at different times, so that the CPU usage of many pods is spread over several runs.
+# Every other run reads the cache file, as a separate run of KAPEL would, and the others use the entry kept in memory, as in daemon mode.
+# A last run at the end of the period again, as for last month's period in auto mode, only uses the cache if there is no overlap.
+# Usage: python misc/check_cache.py [n_pods]
+
+import datetime
+import sys
+import tempfile
+
+from check_harness import PERIOD, process
+from fake_prometheus import SyntheticPods, start_server
+import KAPELCache
+
+# Days between the incremental runs
+RUN_DAYS = 4
+
+if __name__ == "__main__":
+    n_pods = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    server = start_server(SyntheticPods(n_pods, containers=3))
+    period_start = PERIOD['instant'] - datetime.timedelta(seconds=PERIOD['range_sec'])
+    for env in ({'FUSED_QUERIES': 'false'}, {'FUSED_QUERIES': 'true'}, {'FUSED_QUERIES': 'false', 'CACHE_OVERLAP_SEC': '0'},
+                {'COLLECTION_ENGINE': 'range', 'RANGE_QUERY_CHUNK_SEC': str(10 * 86400)},
+                {'COLLECTION_ENGINE': 'range', 'RANGE_QUERY_CHUNK_SEC': str(10 * 86400), 'CACHE_OVERLAP_SEC': '0'}):
+        expected, _ = process(server, env)
+        with tempfile.TemporaryDirectory() as cache_path:
+            cache_env = {**env, 'CACHE_ENABLED': 'true', 'CACHE_PATH': cache_path}
+            n_runs = 0
+            instant = period_start
+            while instant < PERIOD['instant']:
+                instant = min(PERIOD['instant'], instant + datetime.timedelta(days=RUN_DAYS))
+                if n_runs % 2:
+                    KAPELCache._memory.clear()
+                records, log = process(server, cache_env, {**PERIOD, 'instant': instant,
+                                                           'range_sec': int((instant - period_start).total_seconds())})
+                n_runs += 1
+                assert n_runs == 1 or 'Using cached results' in log, 'the cache was not used'
+            assert records == expected, f'{env}: different records with the cache'
+            records, log = process(server, cache_env)
+            n_runs += 1
+            assert ('not querying' in log) == (env.get('CACHE_OVERLAP_SEC') == '0'), 'the up to date cache was not used as expected'
+        print(f'{env}: {len(records)} records after {n_runs} runs with the cache, {len(expected)} without it.')
+        assert records == expected, f'{env}: different records with the cache'
+    print('The records are the same with and without the cache.')
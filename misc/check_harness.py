@@ -0,0 +1,60 @@
+# Shared code for the checks in misc/ that process a period with KAPEL against the fake Prometheus server (fake_prometheus.py)
+# and compare the records written.
+
+import contextlib
+import datetime
+import io
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+from fake_prometheus import BASE_TIME, SPAN
+
+# One period covering all of the synthetic pods, including the time they remain on the cluster after finishing.
+INSTANT = datetime.datetime.fromtimestamp(BASE_TIME + SPAN + 2 * 86400, tz=datetime.timezone.utc)
+PERIOD = {'year': 2023, 'month': 11, 'instant': INSTANT, 'range_sec': SPAN + 2 * 86400}
+
+# Configuration of every check, which the env of each run can override or add to.
+BASE_ENV = {
+    'NAMESPACE': 'example-namespace', 'SITE_NAME': 'site', 'SUBMIT_HOST': 'host', 'VO_NAME': 'vo', 'BENCHMARK_VALUE': '10',
+    'SUMMARIZE_RECORDS': 'false', 'STREAM_QUERIES': 'true', 'QUERY_CONCURRENCY': '4', 'QUERY_RETRY_BACKOFF_SEC': '0',
+}
+
+# Settings made by the previous call of configure, which are removed before the next one so that they don't carry over.
+_configured = set()
+
+# Set the environment for KAPELConfig to BASE_ENV and 'env', with the given server and output path, and return the KAPELConfig.
+def configure(server, output_path, env):
+    from KAPELConfig import KAPELConfig
+    for key in _configured:
+        os.environ.pop(key, None)
+    settings = {**BASE_ENV, 'PROMETHEUS_SERVER': f'http://127.0.0.1:{server.server_port}', 'OUTPUT_PATH': str(output_path), **env}
+    os.environ.update(settings)
+    _configured.clear()
+    _configured.update(settings)
+    return KAPELConfig()
+
+# Return the records in the output queue at 'output_path', each without its message header, as a sorted list,
+# since the order in which pods are found depends on the configuration.
+def read_records(output_path):
+    records = []
+    for path in Path(output_path).glob('[0-9a-f]*/*'):
+        text = path.read_text()
+        records.extend(record + '%%' for record in text.split('\n', 1)[1].split('%%\n') if record)
+    return sorted(records)
+
+# Process a period with the given settings, writing to an empty output queue, and return (records, log).
+# The log is the output of KAPEL, which is not printed. With ADAPTIVE_QUERIES, the QueryHistory is loaded and saved as in a run.
+def process(server, env, period=PERIOD):
+    import KAPEL
+    with tempfile.TemporaryDirectory() as output_path:
+        config = configure(server, output_path, env)
+        history = KAPEL.QueryHistory(config.query_history_path) if config.adaptive_queries else None
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            KAPEL.process_period(config, period, KAPEL.connect_prometheus(config), scheduler=KAPEL.make_scheduler(config, history))
+        if history:
+            history.save()
+        return read_records(output_path), log.getvalue()
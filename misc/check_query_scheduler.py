@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Check that KAPEL produces the same records when Prometheus is busy as when it is not, using the fake Prometheus server:
+# with some queries timing out (which are split in halves straight away, since they already had the full QUERY_TIMEOUT), failing
+# with internal errors (which are retried), and queries over long time ranges failing (which are split), for both collection engines,
+# with timeouts of queries that can't be split (which are retried), and with ADAPTIVE_QUERIES (whose history of a first run is used
+# to shard the queries of a second run). The fake server fails the same queries in every run, so the check is deterministic.
+# Usage: python misc/check_query_scheduler.py [n_pods]
+
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+from check_harness import process
+from fake_prometheus import SyntheticPods, start_server
+
+def count(log, text):
+    return sum(text in line for line in log.splitlines())
+
+# Process the period and return (records, number of queries, log).
+def run(server, env):
+    n_queries = len(server.queries)
+    records, log = process(server, env)
+    return records, len(server.queries) - n_queries, log
+
+if __name__ == "__main__":
+    n_pods = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    healthy = start_server(SyntheticPods(n_pods))
+    # About one in 4 queries times out or fails, and queries over more than 10 days fail
+    busy_servers = [start_server(SyntheticPods(n_pods, fail_every=4, max_range_sec=10 * 86400, fail_error=error)) for error in ('timeout', 'internal')]
+    # The first attempt of every query times out
+    timeouts = start_server(SyntheticPods(n_pods, fail_every=1))
+    with tempfile.TemporaryDirectory() as output_path:
+        for env in ({'COLLECTION_ENGINE': 'instant', 'FUSED_QUERIES': 'false'}, {'COLLECTION_ENGINE': 'instant', 'FUSED_QUERIES': 'true'},
+                    {'COLLECTION_ENGINE': 'range', 'RANGE_QUERY_CHUNK_SEC': str(40 * 86400)}):
+            expected, n_expected, _ = run(healthy, env)
+            for busy in busy_servers:
+                records, n_queries, log = run(busy, env)
+                print(f'{env}, {busy.pods.fail_error} errors: {len(records)} records. {n_expected} queries without failures, {n_queries} with: '
+                      f'{count(log, "Retrying")} retries, {count(log, "Splitting it")} splits.')
+                assert records == expected, f'{env}: different records with {busy.pods.fail_error} errors'
+                assert count(log, 'Splitting it') > 0, 'no queries were split'
+                if busy.pods.fail_error == 'internal':
+                    assert count(log, 'Retrying') > 0, 'no queries were retried'
+
+        # Queries that can't be split, because QUERY_SPLIT_MIN_SEC is longer than the period or for the aggregate summary query,
+        # are retried after timing out.
+        for env in ({'COLLECTION_ENGINE': 'instant', 'FUSED_QUERIES': 'false', 'QUERY_SPLIT_MIN_SEC': str(100 * 86400)},
+                    {'COLLECTION_ENGINE': 'range', 'RANGE_QUERY_CHUNK_SEC': str(40 * 86400), 'QUERY_SPLIT_MIN_SEC': str(100 * 86400)},
+                    {'SUMMARIZE_RECORDS': 'true', 'SUMMARY_ENGINE': 'server'}):
+            expected, _, _ = run(healthy, env)
+            records, n_queries, log = run(timeouts, env)
+            print(f'{env}, timeouts: {len(records)} records. {n_queries} queries: {count(log, "Retrying")} retries, {count(log, "Splitting it")} splits.')
+            assert records == expected, f'{env}: different records with timeouts'
+            assert count(log, 'Retrying') > 0 and count(log, 'Splitting it') == 0, 'the queries that timed out were not retried'
+
+        # The first run with ADAPTIVE_QUERIES records the time of the queries. Scale it as if Prometheus had been 200 times slower,
+        # so that the second run shards the window to keep each query within a quarter of QUERY_TIMEOUT.
+        env = {'COLLECTION_ENGINE': 'instant', 'FUSED_QUERIES': 'false', 'ADAPTIVE_QUERIES': 'true', 'QUERY_TIMEOUT': '60s',
+               'QUERY_HISTORY_PATH': str(Path(output_path) / 'history.json')}
+        expected, _, _ = run(healthy, {'COLLECTION_ENGINE': 'instant', 'FUSED_QUERIES': 'false'})
+        first, _, _ = run(healthy, env)
+        history = Path(output_path) / 'history.json'
+        data = json.loads(history.read_text())
+        for entry in data['queries'].values():
+            entry['rate'] *= 200
+        history.write_text(json.dumps(data))
+        second, n_queries, log = run(healthy, env)
+        shards = [line for line in log.splitlines() if line.startswith('Splitting')]
+        print(f'Adaptive: {len(second)} records. {n_queries} queries in the second run. {shards[0] if shards else "Not sharded."}')
+        assert first == second == expected, 'different records with ADAPTIVE_QUERIES'
+        assert shards, 'the second run with ADAPTIVE_QUERIES was not sharded'
+    print('The records are the same with all the failures.')
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+# Check that the queries of the series recorded by the recording rules (RECORDING_RULES) give the same records as the raw queries,
+# using the fake Prometheus server with pods in 3 namespaces, with and without FUSED_QUERIES, and that in auto mode the recorded
+# series are used if they exist and the raw ones otherwise. Pods have up to 3 containers, which end at different times, so that the
+# CPU usage of the containers that ended earlier must be included.
+# Usage: python misc/check_recording_rules.py [n_pods]
+
+import sys
+
+from check_harness import process
+from fake_prometheus import SyntheticPods, start_server
+
+NAMESPACES = ('ns-a', 'ns-b', 'ns-c')
+ENV = {'NAMESPACES': ','.join(NAMESPACES)}
+
+# Process the period and return (records, whether the recorded series were queried).
+def run(server, env):
+    n_queries = len(server.queries)
+    records, _ = process(server, {**ENV, **env})
+    return records, any('kapel:' in query and not query.startswith('count by') for query in server.queries[n_queries:])
+
+if __name__ == "__main__":
+    n_pods = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    for containers, summarize in ((1, 'false'), (3, 'false'), (3, 'true')):
+        with_rules = start_server(SyntheticPods(n_pods, namespaces=NAMESPACES, recording_rules=True, containers=containers))
+        without_rules = start_server(SyntheticPods(n_pods, namespaces=NAMESPACES, containers=containers))
+        for fused in ('false', 'true'):
+            env = {'FUSED_QUERIES': fused, 'SUMMARIZE_RECORDS': summarize}
+            expected, _ = run(with_rules, {**env, 'RECORDING_RULES': 'false'})
+            for server, recording_rules, used in ((with_rules, 'true', True), (with_rules, 'auto', True), (without_rules, 'auto', False)):
+                records, rules_used = run(server, {**env, 'RECORDING_RULES': recording_rules})
+                name = f'{containers} containers, {env}, RECORDING_RULES={recording_rules}{"" if server is with_rules else " without the rules"}'
+                print(f'{name}: {len(records)} records, {"recorded" if rules_used else "raw"} series queried.')
+                assert rules_used == used, f'{name}: the recorded series were {"not " if used else ""}queried'
+                assert records == expected, f'{name}: different records'
+    print('The records are the same with and without recording rules.')
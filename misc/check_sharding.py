@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+# Check that splitting the query window into shards (QUERY_SHARD_SEC) gives the same records as querying it at once, using the
+# fake Prometheus server with pods whose containers end at different times, so that the CPU usage of many pods is spread over
+# several shards. Also checks that the range collection engine, whose queries are split into chunks, gives the same records.
+# Usage: python misc/check_sharding.py [n_pods]
+
+import sys
+
+from check_harness import process
+from fake_prometheus import SyntheticPods, start_server
+
+if __name__ == "__main__":
+    n_pods = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    server = start_server(SyntheticPods(n_pods, containers=3, recording_rules=True))
+    for env in ({'FUSED_QUERIES': 'false', 'RECORDING_RULES': 'false'}, {'FUSED_QUERIES': 'true', 'RECORDING_RULES': 'false'},
+                {'FUSED_QUERIES': 'false', 'RECORDING_RULES': 'true'}, {'FUSED_QUERIES': 'true', 'RECORDING_RULES': 'true'}):
+        expected, _ = process(server, env)
+        for shard_sec in (86400, 5 * 86400):
+            records, log = process(server, {**env, 'QUERY_SHARD_SEC': str(shard_sec)})
+            print(f'{env}, {shard_sec} s shards: {len(records)} records. {[line for line in log.splitlines() if line.startswith("Splitting")][0]}')
+            assert records == expected, f'{env}: different records with {shard_sec} s shards'
+        if env['RECORDING_RULES'] == 'false':
+            records, _ = process(server, {'COLLECTION_ENGINE': 'range', 'RANGE_QUERY_CHUNK_SEC': str(5 * 86400)})
+            print(f'Range engine: {len(records)} records.')
+            assert records == expected, 'different records from the range engine'
+    print('The records are the same with and without shards.')
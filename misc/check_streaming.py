@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+# Check that streamed decoding of query responses gives the same results as decoding the whole response,
+# using a fake Prometheus server with a large synthetic response, and compare the peak memory usage of both.
+# Each method runs in a separate process so that peak RSS can be measured independently.
+# Usage: python misc/check_streaming.py [n_pods] [extra_labels]
+
+import multiprocessing
+import os
+import resource
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+from fake_prometheus import BASE_TIME, SPAN, SyntheticPods, start_server
+
+# Query a window that includes all of the synthetic pods
+QUERY = f'max_over_time(kube_pod_completion_time{{namespace="example-namespace"}}[{SPAN + 2 * 86400}s])'
+PARAMS = {'time': str(BASE_TIME + SPAN + 2 * 86400)}
+
+def run(url, stream, queue):
+    from KAPEL import run_query
+    from KAPELPrometheus import PrometheusClient
+    prom = PrometheusClient(url)
+    t1 = timer()
+    result = run_query(prom, 'endtime', QUERY, PARAMS, stream=stream)
+    queue.put((result, timer() - t1, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+if __name__ == "__main__":
+    n_pods = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    extra_labels = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    pods = SyntheticPods(n_pods, extra_labels=extra_labels)
+    server = start_server(pods)
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    results = {}
+    for stream in (False, True):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run, args=(url, stream, queue))
+        process.start()
+        # run_query returns {column: {pod: value}}
+        results[stream], seconds, rss = queue.get()
+        results[stream] = results[stream]['endtime']
+        process.join()
+        print(f"{'streamed' if stream else 'buffered'}: {len(results[stream])} pods in {seconds:.2f} s, peak RSS {rss} K")
+
+    expected = {('example-namespace', f'job-{i:08d}'): float(pods.end(i)) for i in range(n_pods)}
+    assert results[True] == results[False] == expected, 'results differ'
+    print('Results are identical.')
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+# Check that summarize_period gives exactly the same results as summarize_period_reference (the original per-job loop),
+# on a synthetic table that includes missing values, negative durations and jobs that ended before the period, and time both.
+# Usage: python misc/check_summary.py [n_pods]
+
+import contextlib
+import os
+import random
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+from KAPEL import summarize_period, summarize_period_reference
+from KAPELTable import PodTable
+
+PERIOD_START = 1698796800
+
+def make_table(n_pods, seed=1):
+    rng = random.Random(seed)
+    table = PodTable()
+    for i in range(n_pods):
+        pod = ('example-namespace', f'job-{i:08d}')
+        start = PERIOD_START + rng.uniform(-86400, 30 * 86400)
+        end = start + rng.uniform(-10, 86400)
+        cores = float(rng.choice([1, 2, 4, 8]))
+        table.merge_max('starttime', [(pod, start)])
+        table.merge_max('cores', [(pod, cores)])
+        # some pods are still running, or have no cputime result
+        if rng.random() < 0.95:
+            table.merge_max('endtime', [(pod, end)])
+            if rng.random() < 0.98:
+                table.merge_max('cputime', [(pod, (end - start) * cores)])
+    return table
+
+if __name__ == "__main__":
+    n_pods = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    table = make_table(n_pods)
+    t1 = timer()
+    summary = summarize_period(table, PERIOD_START)
+    t2 = timer()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        reference = summarize_period_reference(table, PERIOD_START)
+    t3 = timer()
+    print(summary)
+    assert summary == reference, f'summaries differ: {reference}'
+    print(f'Summaries are identical. summarize_period: {t2 - t1:.3f} s, reference: {t3 - t2:.3f} s')
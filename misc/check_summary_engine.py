@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+# Check that the summary records computed from the per-pod results (SUMMARY_ENGINE=pods) and by Prometheus (server) are the same,
+# and that verify finds no differences, using the fake Prometheus server with pods in 3 namespaces that are accounted to
+# different sites and VOs. Periods covering all of the synthetic pods and only some of them are checked, with and without
+# pods that were deleted before their completion time was recorded.
+# Usage: python misc/check_summary_engine.py [n_pods]
+
+import datetime
+import sys
+
+from check_harness import PERIOD, process
+from fake_prometheus import BASE_TIME, SyntheticPods, start_server
+
+NAMESPACES = ('ns-a', 'ns-b', 'ns-c')
+ENV = {'NAMESPACES': ','.join(NAMESPACES), 'NAMESPACE_VO_NAMES': 'ns-b=other-vo', 'NAMESPACE_SITE_NAMES': 'ns-c=other-site',
+       'SUMMARIZE_RECORDS': 'true'}
+
+# The 10 days from 10 days after the start of the synthetic data
+PARTIAL_PERIOD = {'year': 2023, 'month': 11, 'instant': datetime.datetime.fromtimestamp(BASE_TIME + 20 * 86400, tz=datetime.timezone.utc),
+                  'range_sec': 10 * 86400}
+
+if __name__ == "__main__":
+    n_pods = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    for deleted_every in (0, 10):
+        server = start_server(SyntheticPods(n_pods, namespaces=NAMESPACES, deleted_every=deleted_every))
+        for name, period in (('whole', PERIOD), ('partial', PARTIAL_PERIOD)):
+            expected, _ = process(server, {**ENV, 'SUMMARY_ENGINE': 'pods'}, period)
+            records, _ = process(server, {**ENV, 'SUMMARY_ENGINE': 'server'}, period)
+            verified, log = process(server, {**ENV, 'SUMMARY_ENGINE': 'verify'}, period)
+            print(f'deleted_every={deleted_every}, {name} period: {len(expected)} records')
+            assert records == expected, f'deleted_every={deleted_every}, {name} period: different records with SUMMARY_ENGINE=server'
+            assert verified == expected, f'deleted_every={deleted_every}, {name} period: different records with SUMMARY_ENGINE=verify'
+            assert 'they match' in log and 'summary mismatch' not in log, f'deleted_every={deleted_every}, {name} period: verify found differences'
+    print('The summary records are the same with every SUMMARY_ENGINE.')
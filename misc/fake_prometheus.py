@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+# A fake Prometheus server for local testing and benchmarking of KAPEL, without a cluster.
+# It answers instant queries on /api/v1/query with synthetic kube_pod_* results for a configurable number of pods, including those
+# pods whose series exist within the time range of the query. Range queries on /api/v1/query_range return the same metrics at each
+# evaluation during the lifetime of each pod. Pods can have several containers, which end at different times.
+# The results are generated deterministically from the pod index, so every run sees exactly the same data.
+# Responses are generated and written incrementally (chunked transfer encoding), so the server itself stays small
+# even for hundreds of thousands of pods.
+# To test how KAPEL handles a busy Prometheus, it can also fail some queries (see SyntheticPods.failure).
+# Usage: python misc/fake_prometheus.py [n_pods] [port] [--namespaces a,b] [--extra-labels N] [--deleted-every N] [--containers N]
+#                                       [--recording-rules] [--fail-every N] [--fail-error timeout|internal] [--max-range-sec N]
+
+import argparse
+import datetime
+import json
+import math
+import re
+import sys
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Start of the synthetic data, 2023-11-01T00:00:00Z. Pods start and finish within the following 30 days.
+BASE_TIME = 1698796800
+SPAN = 30 * 86400
+# Completed pods remain on the cluster (and in kube-state-metrics) for this long after they finish
+LINGER_SEC = 3600
+
+# Matches each part of a fused query: label_replace(<query>, "kapel_query", "<name>", "", "")
+FUSED_PART = re.compile(r'label_replace\((.*?), "kapel_query", "(\w+)", "", ""\)')
+# Matches the range selectors of a query, e.g. [86400s]
+RANGE_SELECTOR = re.compile(r'\[(\d+)s\]')
+
+class SyntheticPods:
+    def __init__(self, n_pods, namespaces=('example-namespace',), extra_labels=0, deleted_every=0, recording_rules=False,
+                 fail_every=0, max_range_sec=0, fail_error='timeout', containers=1):
+        self.n_pods = n_pods
+        # Pod i has 1 + i % containers containers (see containers())
+        self.n_containers = containers
+        # If set, the first attempt of about one in fail_every queries fails with fail_error ('timeout' or 'internal'), and queries
+        # over more than max_range_sec seconds fail as if they would load too many samples. Which queries fail is decided by a hash
+        # of the query and its time parameters, so that it doesn't depend on the order in which concurrent queries arrive.
+        self.fail_every = fail_every
+        self.fail_error = fail_error
+        self.max_range_sec = max_range_sec
+        self.failed = set()
+        self.lock = threading.Lock()
+        # If set, the series of the KAPEL recording rules (kapel:...) exist as well as the raw ones.
+        self.recording_rules = recording_rules
+        # If set, every deleted_every'th pod is deleted as soon as it finishes, so it never has a completion time.
+        self.deleted_every = deleted_every
+        # Pods are spread evenly over the namespaces
+        self.namespaces = namespaces
+        # Number of additional labels on each series, to simulate the label cardinality of a real deployment.
+        self.extra_labels = extra_labels
+
+    def start(self, i):
+        return BASE_TIME + (i * 7919) % SPAN
+
+    def end(self, i):
+        return self.start(i) + 60 + (i * 104729) % 86400
+
+    def cores(self, i):
+        return float(1 << (i % 4))
+
+    def memory(self, i):
+        return 2000000.0 * (1 + i % 8)
+
+    # Return the CPU usage series of pod i as a list of (labels, end time, cores used): each container of the pod runs from
+    # the start of the pod until its end time, and the last one until the end of the pod.
+    def containers(self, i):
+        n = 1 + i % self.n_containers
+        start = self.start(i)
+        duration = self.end(i) - start
+        return [({'container': f'container-{j}', 'id': f'/kubepods/pod{self.labels(i)["uid"]}/container-{j}'},
+                 start + duration * (j + 1) // n, self.cores(i) * 0.9 / n) for j in range(n)]
+
+    def deleted(self, i):
+        return self.deleted_every and i % self.deleted_every == 0
+
+    def labels(self, i):
+        labels = {'namespace': self.namespaces[i % len(self.namespaces)], 'pod': f'job-{i:08d}', 'uid': f'00000000-0000-0000-0000-{i:012d}',
+                  'instance': '10.0.0.1:8080', 'job': 'kube-state-metrics'}
+        for k in range(self.extra_labels):
+            labels[f'label_{k}'] = f'value-{k}-{i % 100}'
+        return labels
+
+    # Return whether the query uses a metric that series() knows.
+    def supported(self, query):
+        return query.startswith('(') or any(name in query for name in (
+            'container_cpu_usage_seconds_total', 'kapel:', 'resource="memory"', 'resource="cpu"', 'kube_pod_completion_time', 'kube_pod_start_time'))
+
+    # Return the series of pod i used by the query, based on which metrics it uses, as a list of (extra labels, first time, last time,
+    # value function), where the value function gives the result of the query over the samples in (t - range_sec, t] as f(t, range_sec).
+    # CPU usage has a series per container, whose value is the usage up to the end of the window.
+    def series(self, query, i):
+        start, end = self.start(i), self.end(i)
+        linger = 0 if self.deleted(i) else LINGER_SEC
+        if 'container_cpu_usage_seconds_total' in query or 'kapel:container_cpu_usage_seconds' in query:
+            containers = self.containers(i)
+            if query.startswith('sum by (namespace, pod)'):
+                # Summed over the containers with samples in the window
+                return [({}, start, end, lambda t, range_sec: sum((min(t, container_end) - start) * rate for _, container_end, rate in containers
+                                                                  if container_end > t - range_sec))]
+            return [(labels, start, container_end, lambda t, range_sec, container_end=container_end, rate=rate: (min(t, container_end) - start) * rate)
+                    for labels, container_end, rate in containers]
+        if query.startswith('(') or 'kube_pod_completion_time' in query:
+            if self.deleted(i):
+                return []
+            value = (end - start) * self.cores(i) if query.startswith('(') else end
+            return [({}, end, end + linger, lambda t, range_sec: value)]
+        if 'resource="memory"' in query or 'kapel:pod_memory_requests_bytes' in query:
+            value = self.memory(i) / 1000
+        elif 'resource="cpu"' in query or 'kapel:pod_cpu_requests' in query:
+            value = self.cores(i)
+        else:
+            value = start
+        return [({}, start, end + linger, lambda t, range_sec: value)]
+
+    # Generate (labels, value) of the series the query returns at time t, for those that exist within its time range.
+    # A fused query returns the series of each of the queries it combines, tagged with a kapel_query label.
+    def iter_series(self, query, t):
+        fused = FUSED_PART.findall(query)
+        for part, extra_labels in ([(part, {'kapel_query': name}) for part, name in fused] if fused else [(query, {})]):
+            range_sec = max((int(s) for s in RANGE_SELECTOR.findall(part)), default=0)
+            for i in range(self.n_pods):
+                for series_labels, first, last, value in self.series(part, i):
+                    if first <= t and last > t - range_sec:
+                        yield {**self.labels(i), **series_labels, **extra_labels}, value(t, range_sec)
+
+    # Compute the results of the aggregate summary query (SummaryQueryLogic) for each namespace, as Prometheus would
+    # from the per-pod series at time t: jobs are pods with an end time at or after the period start given in the query.
+    def summary_results(self, query, t):
+        period_start = float(re.search(r'>= ([0-9.e+]+)', query).group(1))
+        aggregates = {}
+        for i in range(self.n_pods):
+            if self.deleted(i) or self.end(i) < period_start or self.end(i) > t:
+                continue
+            cputime = (self.end(i) - self.start(i)) * self.cores(i)
+            values = aggregates.setdefault(self.namespaces[i % len(self.namespaces)], {
+                'n_jobs': 0, 'first_end': math.inf, 'last_end': -math.inf, 'n_valid': 0, 'n_negative': 0, 'sum_cputime': 0.0})
+            values['n_jobs'] += 1
+            values['first_end'] = min(values['first_end'], self.end(i))
+            values['last_end'] = max(values['last_end'], self.end(i))
+            values['n_valid'] += 1
+            if cputime < 0:
+                values['n_negative'] += 1
+            else:
+                values['sum_cputime'] += cputime
+        for namespace, values in aggregates.items():
+            for name, value in values.items():
+                if name == 'n_negative' and value == 0:
+                    # count() of no series returns nothing
+                    continue
+                yield {'namespace': namespace, 'kapel_query': name}, value
+
+    # Return (HTTP status, error response) if the query should fail, otherwise None. 'key' identifies the query with its time
+    # parameters, and 'range_sec' is its time range.
+    def failure(self, key, range_sec):
+        fail = False
+        if self.fail_every and zlib.crc32(key.encode()) % self.fail_every == 0:
+            with self.lock:
+                fail = key not in self.failed
+                self.failed.add(key)
+        if fail:
+            if self.fail_error == 'internal':
+                return 500, {'status': 'error', 'errorType': 'internal', 'error': 'internal server error'}
+            return 503, {'status': 'error', 'errorType': 'timeout', 'error': 'query timed out in query execution'}
+        if self.max_range_sec and range_sec > self.max_range_sec:
+            return 422, {'status': 'error', 'errorType': 'execution', 'error': 'query processing would load too many samples into memory'}
+        return None
+
+    # Generate the JSON body of a query response in pieces.
+    def iter_response(self, query, time):
+        if query.startswith('count by (__name__)'):
+            # Check for the recording rule series: one count for each of them, if they are recorded.
+            names = re.findall(r'kapel:[\w:]+', query) if self.recording_rules else []
+            yield json.dumps({'status': 'success', 'data': {'resultType': 'vector', 'result': [
+                {'metric': {'__name__': name}, 'value': [time, repr(float(self.n_pods))]} for name in names]}})
+            return
+        if '"n_jobs"' in query:
+            yield '{"status":"success","data":{"resultType":"vector","result":'
+            yield json.dumps([{'metric': labels, 'value': [time, repr(float(value))]} for labels, value in self.summary_results(query, time)])
+            yield '}}'
+            return
+        if not all(self.supported(part) for part in [part for part, _ in FUSED_PART.findall(query)] or [query]):
+            yield json.dumps({'status': 'error', 'errorType': 'bad_data', 'error': f'unsupported query: {query}'})
+            return
+        yield '{"status":"success","data":{"resultType":"vector","result":['
+        first = True
+        for labels, value in self.iter_series(query, time):
+            yield ('' if first else ',') + json.dumps({'metric': labels, 'value': [time, repr(float(value))]})
+            first = False
+        yield ']}}'
+
+    # Generate the JSON body of a range query response in pieces. Each evaluation at time t covers the samples in (t - step, t],
+    # like max_over_time(...[step]), so a series has a value at every evaluation that overlaps its lifetime.
+    def iter_range_response(self, query, start, end, step):
+        if not self.supported(query):
+            yield json.dumps({'status': 'error', 'errorType': 'bad_data', 'error': f'unsupported query: {query}'})
+            return
+        yield '{"status":"success","data":{"resultType":"matrix","result":['
+        first = True
+        n_max = math.floor((end - start) / step)
+        for i in range(self.n_pods):
+            for series_labels, a, b, value in self.series(query, i):
+                # Evaluations at start + k * step with a <= t < b + step
+                k_min = max(0, math.ceil((a - start) / step))
+                k_max = min(n_max, math.ceil((b + step - start) / step) - 1)
+                if k_min > k_max:
+                    continue
+                values = [[t, repr(float(value(t, step)))] for t in (start + k * step for k in range(k_min, k_max + 1))]
+                item = {'metric': {**self.labels(i), **series_labels}, 'values': values}
+                yield ('' if first else ',') + json.dumps(item)
+                first = False
+        yield ']}}'
+
+# Parse a query time, given as a Unix timestamp or in RFC 3339 format like Prometheus.
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.handle_query(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.handle_query(urlparse(self.path).path, parse_qs(self.rfile.read(length).decode()))
+
+    def handle_query(self, path, params):
+        if path not in ('/api/v1/query', '/api/v1/query_range') or 'query' not in params:
+            self.send_error(404)
+            return
+        query = params['query'][0]
+        self.server.queries.append(query)
+        if path == '/api/v1/query_range':
+            range_sec = float(params['end'][0]) - float(params['start'][0])
+            error = 'end timestamp must not be before start time' if range_sec < 0 else None
+        else:
+            # The longest range selector of the query
+            range_sec = max((int(s) for s in RANGE_SELECTOR.findall(query)), default=0)
+            error = 'duration must be greater than 0' if '[0s]' in query else None
+        if error:
+            self.send_json(400, {'status': 'error', 'errorType': 'bad_data', 'error': error})
+            return
+        key = ' '.join(params.get(name, [''])[0] for name in ('query', 'time', 'start', 'end', 'step'))
+        failure = self.server.pods.failure(key, range_sec)
+        if failure:
+            self.send_json(*failure)
+            return
+        if path == '/api/v1/query_range':
+            pieces = self.server.pods.iter_range_response(query, float(params['start'][0]), float(params['end'][0]), float(params['step'][0]))
+        else:
+            pieces = self.server.pods.iter_response(query, parse_time(params['time'][0]) if 'time' in params else BASE_TIME + SPAN)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        # Group the generated pieces into larger chunks to keep the overhead of chunked encoding low.
+        buf = []
+        size = 0
+        for piece in pieces:
+            buf.append(piece)
+            size += len(piece)
+            if size >= 65536:
+                self.write_chunk(''.join(buf))
+                buf = []
+                size = 0
+        if buf:
+            self.write_chunk(''.join(buf))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Clients closing keep-alive connections are normal, don't print a traceback for them.
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+# Start a fake Prometheus server in a background thread. Returns the server; its URL is http://127.0.0.1:<server.server_port>
+def start_server(pods, port=0):
+    server = Server(('127.0.0.1', port), Handler)
+    server.pods = pods
+    server.queries = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic kube-state-metrics and cAdvisor query results like Prometheus.")
+    parser.add_argument('n_pods', nargs='?', type=int, default=10000)
+    parser.add_argument('port', nargs='?', type=int, default=9090, help='0 picks a free port')
+    parser.add_argument('--namespaces', default='example-namespace', help='comma-separated namespaces to spread the pods over')
+    parser.add_argument('--extra-labels', type=int, default=0, help='number of additional labels on each series')
+    parser.add_argument('--deleted-every', type=int, default=0, help="delete every N'th pod as soon as it finishes")
+    parser.add_argument('--containers', type=int, default=1, help="give pod i 1 + i %% N containers, which end at different times")
+    parser.add_argument('--recording-rules', action='store_true', help='also serve the series of the KAPEL recording rules')
+    parser.add_argument('--fail-every', type=int, default=0, help='fail the first attempt of about one in N queries')
+    parser.add_argument('--fail-error', choices=('timeout', 'internal'), default='timeout', help='how the --fail-every queries fail')
+    parser.add_argument('--max-range-sec', type=int, default=0, help='fail queries over a longer time range than this')
+    args = parser.parse_args()
+    pods = SyntheticPods(args.n_pods, namespaces=tuple(args.namespaces.split(',')), extra_labels=args.extra_labels,
+                         deleted_every=args.deleted_every, recording_rules=args.recording_rules,
+                         fail_every=args.fail_every, max_range_sec=args.max_range_sec, fail_error=args.fail_error, containers=args.containers)
+    server = start_server(pods, args.port)
+    print(f'Fake Prometheus serving {args.n_pods} pods on http://127.0.0.1:{server.server_port}', flush=True)
+    threading.Event().wait()
@@ -9,29 +9,58 @@
 # Requires python >= 3.6 for new f-strings
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
+import json
+import math
 import resource
 from timeit import default_timer as timer
+from array import array
 import dateutil.relativedelta
 from dateutil.rrule import rrule, MONTHLY
-from os import listdir, mkdir
+from os import listdir
 from os.path import isfile, join
-from pathlib import Path
-from shutil import copyfile
 
 from KAPELConfig import KAPELConfig
-from prometheus_api_client import PrometheusConnect
+from KAPELCache import PeriodCache
+from KAPELDaemon import run_daemon
+from KAPELIndex import PublishedIndex
+from KAPELMetrics import RunReport, profiled
+from KAPELPrometheus import PrometheusClient, PrometheusQueryError
+from KAPELScheduler import QueryHistory, QueryScheduler
+from KAPELTable import PodTable
 from dirq.QueueSimple import QueueSimple
 
 # for debugging
 #import code
 #from memory_profiler import profile
 
+# Return the PromQL label matcher selecting the given namespaces.
+# Namespace names can only contain lowercase alphanumerics and '-', so they need no escaping in the regex.
+def namespace_selector(namespaces):
+    if len(namespaces) == 1:
+        return f'namespace="{namespaces[0]}"'
+    return f'namespace=~"{"|".join(namespaces)}"'
+
+# Names of the pre-aggregated series recorded by the recording rules in the Helm chart (chart/templates/recording-rules.yaml),
+# by the queries that can use them instead of the raw metrics.
+RECORDING_RULE_METRICS = {
+    'cpuusage_series': 'kapel:container_cpu_usage_seconds:max',
+    'cores': 'kapel:pod_cpu_requests:max',
+    'memory': 'kapel:pod_memory_requests_bytes:sum',
+}
+
 # Contains the PromQL queries
 class QueryLogic:
-    def __init__(self, queryRange, namespace):
+    def __init__(self, queryRange, namespaces, recording_rules=False):
         # Use a query that returns individual job records to get high granularity information, which can be processed into summary records as needed.
 
+        # All namespaces are queried at once, and results are grouped by (namespace, pod) so they can be attributed to each namespace afterwards.
+        namespace = namespace_selector(namespaces)
+
         # queryRange determines how far back to query. The query will cover the period from (t - queryRange) to t,
         # where 't' is defined in the Prometheus connection parameters.
         # See https://prometheus.io/docs/prometheus/latest/querying/basics/#range-vector-selectors
@@ -52,23 +81,118 @@ class QueryLogic:
         # (which takes a range and returns a scalar), and as a result get the whole metric set. Finally, use group_left for many-to-one matching.
         # https://prometheus.io/docs/prometheus/latest/querying/operators/#aggregation-operators
         # https://prometheus.io/docs/prometheus/latest/querying/operators/#many-to-one-and-one-to-many-vector-matches
-        self.cputime = f'(max_over_time(kube_pod_completion_time{{namespace="{namespace}"}}[{queryRange}]) - max_over_time(kube_pod_start_time{{namespace="{namespace}"}}[{queryRange}])) * on (pod) group_left() max without (instance, node) (max_over_time(kube_pod_container_resource_requests{{resource="cpu", node != "", namespace="{namespace}"}}[{queryRange}]))'
-        self.endtime = f'max_over_time(kube_pod_completion_time{{namespace="{namespace}"}}[{queryRange}])'
-        self.starttime = f'max_over_time(kube_pod_start_time{{namespace="{namespace}"}}[{queryRange}])'
-        self.cores = f'max_over_time(kube_pod_container_resource_requests{{resource="cpu", node != "", namespace="{namespace}"}}[{queryRange}])'
-        self.memory = f'sum by (pod) (max_over_time(kube_pod_container_resource_requests{{resource="memory", node!="", namespace="{namespace}"}}[{queryRange}])) / 1000'
+        # If recording_rules is true, the series recorded by the rules in RECORDING_RULE_METRICS are used for the cores, memory and CPU usage
+        # (and the cores of the cputime query) instead. The requests have one series per pod, already aggregated over containers,
+        # KSM instances and nodes, and the CPU usage one series per container (namespace, pod, container, id) without the other cAdvisor
+        # labels, so Prometheus has far fewer series and labels to load. The CPU usage is recorded per container rather than per pod,
+        # and summed client-side as for the raw series, since a per-pod sum at each evaluation would lose the usage of containers that
+        # ended earlier (e.g. init containers and restarted containers). The results are the same as those of the raw queries.
+        if recording_rules:
+            cores = f'max_over_time({RECORDING_RULE_METRICS["cores"]}{{{namespace}}}[{queryRange}])'
+        else:
+            cores = f'max without (instance, node) (max_over_time(kube_pod_container_resource_requests{{resource="cpu", node != "", {namespace}}}[{queryRange}]))'
+        self.cputime = f'(max_over_time(kube_pod_completion_time{{{namespace}}}[{queryRange}]) - max_over_time(kube_pod_start_time{{{namespace}}}[{queryRange}])) * on (namespace, pod) group_left() {cores}'
+        self.endtime = f'max_over_time(kube_pod_completion_time{{{namespace}}}[{queryRange}])'
+        self.starttime = f'max_over_time(kube_pod_start_time{{{namespace}}}[{queryRange}])'
+        if recording_rules:
+            self.cores = f'max_over_time({RECORDING_RULE_METRICS["cores"]}{{{namespace}}}[{queryRange}])'
+            self.memory = f'max_over_time({RECORDING_RULE_METRICS["memory"]}{{{namespace}}}[{queryRange}]) / 1000'
+            self.cpuusage_series = f'max by (namespace, pod, container, id) (last_over_time({RECORDING_RULE_METRICS["cpuusage_series"]}{{{namespace}}}[{queryRange}]))'
+        else:
+            self.cores = f'max_over_time(kube_pod_container_resource_requests{{resource="cpu", node != "", {namespace}}}[{queryRange}])'
+            self.memory = f'sum by (namespace, pod) (max_over_time(kube_pod_container_resource_requests{{resource="memory", node!="", {namespace}}}[{queryRange}])) / 1000'
+
+            # This is container-level CPU usage reported by kubelets, for gratia output.
+            # Take the largest (i.e. final) value of the cumulative CPU usage of each container, which is summed for all containers of a pod
+            # client-side (see SERIES_COLUMNS). Summing it here would not give results that can be merged across shards or with the cache:
+            # a container that ended in one shard has no series in the next, so the sum for the pod would be lower there.
+            # Each container run has its own cgroup 'id', so a restarted container has a series for each run.
+            self.cpuusage_series = f'max by (namespace, pod, container, id) (last_over_time(container_cpu_usage_seconds_total{{{namespace}}}[{queryRange}]))'
+
+# Name of the label that identifies which query each series of the fused query came from.
+FUSED_LABEL = 'kapel_query'
+
+# Fetches the same data as QueryLogic in a single query (one round trip, and one evaluation of each range vector).
+# Each of the underlying queries is tagged with a FUSED_LABEL label naming it, using label_replace, and they are combined with 'or'.
+# Since the tag makes the label sets of the different queries distinct, 'or' keeps all the series of all of them.
+# cputime is not queried: it re-evaluates the endtime, starttime and cores range vectors, so instead it is derived client-side
+# from those results (see derive_cputime), which roughly halves the amount of data Prometheus needs to load.
+# https://prometheus.io/docs/prometheus/latest/querying/functions/#label_replace
+class FusedQueryLogic:
+    def __init__(self, queryRange, namespaces, recording_rules=False):
+        queries = QueryLogic(queryRange, namespaces, recording_rules)
+        self.fused = ' or '.join(
+            f'label_replace({query_string}, "{FUSED_LABEL}", "{query_name}", "", "")'
+            for query_name, query_string in vars(queries).items() if query_name != 'cputime'
+        )
+
+# The PromQL queries of the range collection engine (COLLECTION_ENGINE = range), which are evaluated with query_range every 'step'.
+# Each evaluation takes the max_over_time of the last 'step', so that consecutive evaluations cover every sample exactly once,
+# but only has to load a short window of each series, rather than the whole period as with QueryLogic.
+# The results are keyed by pod UID (the 'uid' label of kube-state-metrics v2), so a pod name that is reused (e.g. by a StatefulSet)
+# is accounted as separate jobs. The requests of all containers of a pod are summed.
+# cAdvisor metrics have no uid label, so the CPU usage of each pod is given the uid of the pod that had that name at the time,
+# which is taken from kube_pod_start_time. If two pods with the same name exist within one step, the latest started one is used.
+# As with QueryLogic, the CPU usage is queried per container series and summed client-side, since the sum at each evaluation
+# would not include the containers that had already ended.
+class RangeQueryLogic:
+    def __init__(self, step, namespaces):
+        namespace = namespace_selector(namespaces)
+        self.starttime = f'max by (namespace, pod, uid) (max_over_time(kube_pod_start_time{{{namespace}}}[{step}]))'
+        self.endtime = f'max by (namespace, pod, uid) (max_over_time(kube_pod_completion_time{{{namespace}}}[{step}]))'
+        self.cores = f'sum by (namespace, pod, uid) (max by (namespace, pod, uid, container) (max_over_time(kube_pod_container_resource_requests{{resource="cpu", node != "", {namespace}}}[{step}])))'
+        self.memory = f'sum by (namespace, pod, uid) (max by (namespace, pod, uid, container) (max_over_time(kube_pod_container_resource_requests{{resource="memory", node != "", {namespace}}}[{step}]))) / 1000'
+        self.cpuusage_series = f'max by (namespace, pod, container, id) (max_over_time(container_cpu_usage_seconds_total{{{namespace}}}[{step}])) + on (namespace, pod) group_left(uid) (0 * topk by (namespace, pod) (1, max by (namespace, pod, uid) (max_over_time(kube_pod_start_time{{{namespace}}}[{step}]))))'
+
+# Aggregate queries for summary records computed by Prometheus (SUMMARY_ENGINE = server), so that only a few numbers per namespace
+# are returned instead of a result per pod for each query. They give the fields of PeriodSummary for each namespace, in the same way
+# as summarize_period does from the per-pod results of QueryLogic: jobs are the pods with an end time in the period
+# (at or after period_start_ts), and valid jobs are those which also have a cputime result. Duplicate series of a pod
+# (e.g. from different KSM instances) are collapsed by taking the max, as when the per-pod results are merged.
+# The queries are combined into a single one like FusedQueryLogic, tagged with FUSED_LABEL.
+# The results cannot be merged across time windows, so the cache and QUERY_SHARD_SEC are not used for them.
+class SummaryQueryLogic:
+    def __init__(self, queryRange, namespaces, period_start_ts):
+        queries = QueryLogic(queryRange, namespaces)
+        ended = f'max by (namespace, pod) ({queries.endtime}) >= {float(period_start_ts)!r}'
+        valid = f'max by (namespace, pod) ({queries.cputime}) and on (namespace, pod) ({ended})'
+        aggregates = {
+            'n_jobs': f'count by (namespace) ({ended})',
+            'first_end': f'min by (namespace) ({ended})',
+            'last_end': f'max by (namespace) ({ended})',
+            'n_valid': f'count by (namespace) ({valid})',
+            # Jobs with an end time before their start time have a negative cputime, and are excluded from the sum.
+            'n_negative': f'count by (namespace) (({valid}) < 0)',
+            'sum_cputime': f'sum by (namespace) (({valid}) >= 0)',
+        }
+        self.summary = ' or '.join(
+            f'label_replace({query_string}, "{FUSED_LABEL}", "{name}", "", "")' for name, query_string in aggregates.items()
+        )
 
-        # This is container-level CPU usage reported by kubelets, for gratia output.
-        # Take the largest (i.e. final) value of the cumulative CPU usage of each container, and sum the results for all containers in a pod.
-        self.cpuusage = f'sum by (pod) (last_over_time(container_cpu_usage_seconds_total{{namespace="{namespace}"}}[{queryRange}]))'
+# Return the queries to run for the given query range, according to the configuration.
+# For the range collection engine, the queries don't depend on the query range, and recording rules are not used.
+def make_queries(config, queryRange, recording_rules=False):
+    if config.collection_engine == 'range':
+        return RangeQueryLogic(step=f'{config.range_query_step_sec}s', namespaces=config.namespaces)
+    if config.fused_queries:
+        return FusedQueryLogic(queryRange=queryRange, namespaces=config.namespaces, recording_rules=recording_rules)
+    return QueryLogic(queryRange=queryRange, namespaces=config.namespaces, recording_rules=recording_rules)
 
-def summary_message(config, year, month, wall_time, cpu_time, n_jobs, first_end, last_end):
+# Return a hash of the query definitions, independent of the query range.
+# Used to detect when cached results were produced by different queries.
+# The queries using recording rules give the same results as the raw ones, so they have the same signature.
+def query_signature(config):
+    queries = make_queries(config, queryRange='RANGE')
+    return hashlib.sha256(json.dumps(vars(queries), sort_keys=True).encode()).hexdigest()
+
+# site_name and vo_name can be given to override the configured ones, e.g. for a namespace with its own VO.
+def summary_message(config, year, month, wall_time, cpu_time, n_jobs, first_end, last_end, site_name=None, vo_name=None):
     output = (
         f'APEL-summary-job-message: v0.2\n'
-        f'Site: {config.site_name}\n'
+        f'Site: {site_name or config.site_name}\n'
         f'Month: {month}\n'
         f'Year: {year}\n'
-        f'VO: {config.vo_name}\n'
+        f'VO: {vo_name or config.vo_name}\n'
         f'SubmitHost: {config.submit_host}\n'
         f'InfrastructureType: {config.infrastructure_type}\n'
         #f'InfrastructureDescription: {config.infrastructure_description}\n'
@@ -86,12 +210,14 @@ def summary_message(config, year, month, wall_time, cpu_time, n_jobs, first_end,
     )
     return output
 
-def individual_message(config, pod_name, memory, cores, wall_time, cpu_time, start_time, end_time):
-    """ Write an APEL individual job message based on prometheus metrics from a single pod, without benchmark values. """
+# The header line of an individual job message. A message may contain many records following the header, each ending with '%%'.
+INDIVIDUAL_HEADER = 'APEL-individual-job-message: v0.3\n'
+
+def individual_record(config, pod_name, memory, cores, wall_time, cpu_time, start_time, end_time, site_name=None, vo_name=None):
+    """ Write an APEL individual job record (without the message header) based on prometheus metrics from a single pod, without benchmark values. """
     output = (
-        f'APEL-individual-job-message: v0.3\n'
-        f'Site: {config.site_name}\n'
-        f'VO: {config.vo_name}\n'
+        f'Site: {site_name or config.site_name}\n'
+        f'VO: {vo_name or config.vo_name}\n'
         f'SubmitHost: {config.submit_host}\n'
         f'MachineName: {pod_name}\n'
         f'LocalJobId: {pod_name}\n'
@@ -107,10 +233,10 @@ def individual_message(config, pod_name, memory, cores, wall_time, cpu_time, sta
     )
     return output
 
-def sync_message(config, year, month, n_jobs):
+def sync_message(config, year, month, n_jobs, site_name=None):
     output = (
         f'APEL-sync-message: v0.1\n'
-        f'Site: {config.site_name}\n'
+        f'Site: {site_name or config.site_name}\n'
         f'SubmitHost: {config.submit_host}\n'
         f'NumberOfJobs: {n_jobs}\n'
         f'Month: {month}\n'
@@ -177,196 +303,1009 @@ def get_gap_time_periods(start, end):
     # return value is list of dicts of (int, int, datetime, int)
     return periods
 
+# Queries with a result per series rather than per pod, by the name of the pod column their results are summed into (see sum_series).
+# Their results are keyed by the pod key followed by the values of SERIES_LABELS.
+SERIES_COLUMNS = {'cpuusage_series': 'cpuusage'}
+SERIES_LABELS = ('container', 'id')
+
+# Return the key of a result of the given query: (namespace, pod) followed by the values of 'labels',
+# and the SERIES_LABELS for the per-series queries. Labels with an empty value are missing from the results.
+def result_key(query_name, metric, labels=()):
+    key = (metric['namespace'], metric['pod']) + tuple(metric[label] for label in labels)
+    if query_name in SERIES_COLUMNS:
+        key += tuple(metric.get(label, '') for label in SERIES_LABELS)
+    return key
+
 # Take a list of dicts from the prom query and construct a random-accessible dict (casting from string to float while we're at it) via generator.
-# (actually a list of tuples, so use dict() on the output) that can be referenced by the 'pod' label as a key.
-# NB: this overwrites duplicate results if we get any from the prom query!
-def rearrange(x):
+# (actually a list of tuples, so use dict() on the output) that can be referenced by the ('namespace', 'pod') labels as a key (see result_key).
+# NB: this overwrites duplicate results if we get any from the prom query! run_query counts them (see count_duplicate).
+def rearrange(query_name, x):
     for item in x:
         # this produces each of the (key, value) tuples in the list
-        yield item['metric']['pod'], float(item['value'][1])
-
-
-def record_summarized_period(config, period_start, year, month, results):
-    """ Record the sum of usage across all pods in the given time period. """
-    cputime = results['cputime']
-    endtime = results['endtime']
-    starttime = results['starttime']
-    cores = results['cores']
-    # Note that jobs which started last month and finished this month will be properly included and accounted in this month.
-    # However, jobs that finished last month may show up in this month's data if they are still present on the cluster this month (in Completed state).
-    # Exclude them by filtering with a lambda (since you can't pass an argument to a function object AFAIK).
-    endtime = dict(filter(lambda x: x[1] >= datetime.datetime.timestamp(period_start), endtime.items()))
-    # Prepare to iterate over jobs which meet all criteria: the cputime result exists, so there must be a valid start and end time, and core count.
-    valid_jobs = cputime.keys() & endtime.keys()
-    # avoid sending empty records
-    if len(valid_jobs) == 0:
-        print('No records to process.')
-        return
+        yield result_key(query_name, item['metric']), float(item['value'][1])
+
+# Like rearrange, for the results of the fused query: produces (query name, key, value) tuples.
+def rearrange_fused(x):
+    for item in x:
+        query_name = item['metric'][FUSED_LABEL]
+        yield query_name, result_key(query_name, item['metric']), float(item['value'][1])
+
 
+# Like rearrange_fused, for the results of the summary query, which are keyed by namespace only.
+def rearrange_summary(x):
+    for item in x:
+        yield item['metric'][FUSED_LABEL], (item['metric']['namespace'],), float(item['value'][1])
+
+# Reduce the results of a range query to (column, key, value) tuples, with the largest value of each series over the queried range.
+# Each series of the starttime query also produces a 'lastseen' value, the time of the last evaluation in which the pod was present.
+def rearrange_range(query_name, x):
+    for item in x:
+        key = result_key(query_name, item['metric'], ('uid',))
+        values = item['values']
+        yield query_name, key, max(float(value) for _, value in values)
+        if query_name == 'starttime':
+            yield 'lastseen', key, float(values[-1][0])
+
+# Totals for the jobs of a time period, as used for summary records.
+# n_jobs counts the jobs that ended in the period, n_valid those which also have a cputime result,
+# and n_negative and n_inconsistent count the valid jobs excluded from sum_cputime due to anomalies.
+PeriodSummary = collections.namedtuple('PeriodSummary',
+    ['n_jobs', 'n_valid', 'sum_cputime', 'first_end', 'last_end', 'n_negative', 'n_inconsistent'])
+
+def summarize_period(table, period_start_ts, namespaces=None):
+    """ Compute the PeriodSummary of a table in a single pass over its aligned columns.
+    If namespaces is given, only pods in those namespaces are included. """
+    n_jobs = 0
+    n_valid = 0
+    n_negative = 0
+    n_inconsistent = 0
     sum_cputime = 0
-    t4 = timer()
-    for key in valid_jobs:
-        if endtime[key] < starttime[key]:
+    first_end = math.inf
+    last_end = -math.inf
+    for pod, cputime, endtime, starttime, cores in zip(table.pods, table.column('cputime'), table.column('endtime'),
+                                                        table.column('starttime'), table.column('cores')):
+        if namespaces is not None and pod[0] not in namespaces:
+            continue
+        # Note that jobs which started last month and finished this month will be properly included and accounted in this month.
+        # However, jobs that finished last month may show up in this month's data if they are still present on the cluster this month (in Completed state).
+        # Exclude them by only keeping the rows with an end time in this period (NaN, i.e. no end time, compares false).
+        if not endtime >= period_start_ts:
+            continue
+        n_jobs += 1
+        if endtime < first_end:
+            first_end = endtime
+        if endtime > last_end:
+            last_end = endtime
+        # Only jobs with a cputime result have a valid start and end time, and core count.
+        if cputime != cputime:
+            continue
+        n_valid += 1
+        if endtime < starttime:
             # could happen due to inaccurate clocks?
-            print(f'WARNING: ignoring job {key} with negative duration: start={starttime[key]}, end={endtime[key]}')
+            n_negative += 1
             continue
         # double check cputime calc of this job
-        delta = abs(cputime[key] - (endtime[key] - starttime[key])*cores[key])
+        if not abs(cputime - (endtime - starttime)*cores) < 0.001:
+            n_inconsistent += 1
+            continue
+        sum_cputime += cputime
+    return PeriodSummary(n_jobs, n_valid, sum_cputime, first_end, last_end, n_negative, n_inconsistent)
+
+def summarize_period_reference(table, period_start_ts, namespaces=None):
+    """ Compute the PeriodSummary of a table one job at a time. This is the original (slower) algorithm, kept for
+    verifying summarize_period. It fails on the first job with an inconsistent cputime instead of counting them. """
+    cputime = table.column('cputime')
+    endtime = table.column('endtime')
+    starttime = table.column('starttime')
+    cores = table.column('cores')
+    ended = [row for row, end in enumerate(endtime) if end >= period_start_ts and (namespaces is None or table.pods[row][0] in namespaces)]
+    valid_jobs = [row for row in ended if not math.isnan(cputime[row])]
+
+    sum_cputime = 0
+    n_negative = 0
+    for row in valid_jobs:
+        if endtime[row] < starttime[row]:
+            print(f'WARNING: ignoring job {table.pods[row][1]} with negative duration: start={starttime[row]}, end={endtime[row]}')
+            n_negative += 1
+            continue
+        delta = abs(cputime[row] - (endtime[row] - starttime[row])*cores[row])
         assert delta < 0.001, "cputime calculation is inaccurate"
-        sum_cputime += cputime[key]
-
-    # CPU time as calculated here means (# cores * job duration), which apparently corresponds to
-    # the concept of wall time in APEL accounting. It is not clear what CPU time means in APEL;
-    # could be the actual CPU usage % integrated over the job (# cores * job duration * usage)
-    # but this does not seem to be documented clearly. Some batch systems do not actually measure
-    # this so it is not reported consistently or accurately. Some sites have CPU efficiency
-    # (presumably defined as CPU time / wall time) time that is up to ~ 500% of the walltime, or
-    # always fixed at 100%. In Kubernetes, the actual CPU usage % is tracked by metrics server
-    # (not KSM), which is not meant to be used for monitoring or accounting purposes and is not
-    # scraped by Prometheus. So just use walltime = cputime
-    sum_cputime = round(sum_cputime)
-    sum_walltime = sum_cputime
-
-    print(f'total cputime: {sum_cputime}, total walltime: {sum_walltime}')
-    t5 = timer()
-    print(f'Analyzed {len(endtime)} records in {t5 - t4} s.')
-
-    summary_output = summary_message(
-        config,
-        year=year,
-        month=month,
-        wall_time=sum_walltime,
-        cpu_time=sum_cputime,
-        n_jobs=len(endtime),
-        # this appears faster than getting min/max during the dict iteration above
-        first_end=round(min(endtime.values())),
-        last_end=round(max(endtime.values()))
-    )
-    sync_output = sync_message(config, year=year, month=month, n_jobs=len(endtime))
+        sum_cputime += cputime[row]
+    return PeriodSummary(len(ended), len(valid_jobs), sum_cputime,
+                         min((endtime[row] for row in ended), default=math.inf),
+                         max((endtime[row] for row in ended), default=-math.inf),
+                         n_negative, 0)
 
+def summarize_groups(config, table, period_start):
+    """ Compute the PeriodSummary of each (site, VO) combination of the configured namespaces from the per-pod results. """
+    summaries = {}
+    for group, namespaces in config.namespace_groups().items():
+        t4 = timer()
+        # With a single group (the usual case) there is no need to filter by namespace.
+        summaries[group] = summarize_period(table, datetime.datetime.timestamp(period_start),
+                                            namespaces=set(namespaces) if len(config.namespaces) > 1 else None)
+        t5 = timer()
+        print(f'Analyzed {summaries[group].n_jobs} records in {t5 - t4} s.')
+    return summaries
+
+def server_summaries(config, prom, period, period_start, report=None, scheduler=None):
+    """ Compute the PeriodSummary of each (site, VO) combination of the configured namespaces with aggregate queries (SummaryQueryLogic).
+    The aggregates can't be combined over parts of the period, so the query is retried by the QueryScheduler but never split. """
+    queries = SummaryQueryLogic(queryRange=f"{period['range_sec']}s", namespaces=config.namespaces,
+                                period_start_ts=datetime.datetime.timestamp(period_start))
+    scheduler = scheduler or make_scheduler(config)
+
+    def attempt(timeout):
+        params = {'time': period['instant'].isoformat(), 'timeout': f'{timeout}s'}
+        return run_query(prom, 'summary', queries.summary, params, config.stream_queries, report)
+    results = scheduler.run('summary', period['range_sec'], attempt)
+    summaries = {}
+    for group, namespaces in config.namespace_groups().items():
+        # Aggregations over no series return no result, e.g. for a namespace without any jobs in the period.
+        def values(column):
+            return [results[column][(namespace,)] for namespace in namespaces if (namespace,) in results.get(column, {})]
+        summaries[group] = PeriodSummary(
+            n_jobs=round(sum(values('n_jobs'))),
+            n_valid=round(sum(values('n_valid'))),
+            sum_cputime=sum(values('sum_cputime')),
+            first_end=min(values('first_end'), default=math.inf),
+            last_end=max(values('last_end'), default=-math.inf),
+            n_negative=round(sum(values('n_negative'))),
+            n_inconsistent=0)
+    return summaries
+
+def compare_summaries(pod_summaries, server_summaries):
+    """ Compare the summaries computed from the per-pod results with those computed by Prometheus (SUMMARY_ENGINE = verify).
+    Prints any differences and returns the number of them. The sums of cputime may differ by floating point rounding. """
+    differences = 0
+    for group, pods in pod_summaries.items():
+        server = server_summaries[group]
+        for field in PeriodSummary._fields:
+            pod_value, server_value = getattr(pods, field), getattr(server, field)
+            if field == 'n_inconsistent' or math.isclose(pod_value, server_value, rel_tol=1e-9, abs_tol=1e-3):
+                continue
+            print(f'WARNING: summary mismatch for site {group[0]}, VO {group[1]}: {field} is {pod_value} from the per-pod results, '
+                  f'but {server_value} from the aggregate queries.')
+            differences += 1
+    if not differences:
+        print('Verified the summaries against the aggregate queries: they match.')
+    return differences
+
+def record_summarized_period(config, year, month, summaries, report=None):
+    """ Record the sum of usage across all pods in the given time period.
+    One summary record is produced for each (site, VO) combination of the configured namespaces, given in 'summaries' as a dict of
+    {(site, VO): PeriodSummary}, and one sync record for each site.
+    Returns the number of records written, and adds them to the PeriodReport if given.
+    """
     # Write output to the message queue on local filesystem
     # https://dirq.readthedocs.io/en/latest/queuesimple.html#directory-structure
     dirq = QueueSimple(str(config.output_path))
-    summary_file = dirq.add(summary_output)
-    sync_file = dirq.add(sync_output)
-    print(f'Writing summary record to {config.output_path}/{summary_file}:')
-    print('--------------------------------\n' + summary_output + '--------------------------------')
-    print(f'Writing sync record to {config.output_path}/{sync_file}:')
-    print('--------------------------------\n' + sync_output + '--------------------------------')
-
-def record_individual_period(config, results):
-    """ Record each pod in the namespace over the summarized period.
+    n_summaries = 0
+    site_jobs = {}
+    for (site_name, vo_name), namespaces in config.namespace_groups().items():
+        summary = summaries[(site_name, vo_name)]
+        # avoid sending empty records
+        if summary.n_valid == 0:
+            print(f'No records to process for site {site_name}, VO {vo_name} (namespaces {", ".join(namespaces)}).')
+            continue
+        if summary.n_negative:
+            print(f'WARNING: ignoring {summary.n_negative} jobs with negative duration (end time before start time).')
+        assert summary.n_inconsistent == 0, f"cputime calculation is inaccurate for {summary.n_inconsistent} jobs"
+
+        # CPU time as calculated here means (# cores * job duration), which apparently corresponds to
+        # the concept of wall time in APEL accounting. It is not clear what CPU time means in APEL;
+        # could be the actual CPU usage % integrated over the job (# cores * job duration * usage)
+        # but this does not seem to be documented clearly. Some batch systems do not actually measure
+        # this so it is not reported consistently or accurately. Some sites have CPU efficiency
+        # (presumably defined as CPU time / wall time) time that is up to ~ 500% of the walltime, or
+        # always fixed at 100%. In Kubernetes, the actual CPU usage % is tracked by metrics server
+        # (not KSM), which is not meant to be used for monitoring or accounting purposes and is not
+        # scraped by Prometheus. So just use walltime = cputime
+        sum_cputime = round(summary.sum_cputime)
+        sum_walltime = sum_cputime
+
+        print(f'total cputime: {sum_cputime}, total walltime: {sum_walltime}')
+
+        summary_output = summary_message(
+            config,
+            year=year,
+            month=month,
+            wall_time=sum_walltime,
+            cpu_time=sum_cputime,
+            n_jobs=summary.n_jobs,
+            first_end=round(summary.first_end),
+            last_end=round(summary.last_end),
+            site_name=site_name,
+            vo_name=vo_name
+        )
+        t6 = timer()
+        summary_file = dirq.add(summary_output)
+        n_summaries += 1
+        if report:
+            report.add_output('summary', 1, 1, len(summary_output), timer() - t6)
+        print(f'Writing summary record to {config.output_path}/{summary_file}:')
+        print('--------------------------------\n' + summary_output + '--------------------------------')
+        site_jobs[site_name] = site_jobs.get(site_name, 0) + summary.n_jobs
+
+    # The sync record gives the total number of jobs of the site (for this submit host), across all of its VOs.
+    for site_name, n_jobs in site_jobs.items():
+        sync_output = sync_message(config, year=year, month=month, n_jobs=n_jobs, site_name=site_name)
+        t6 = timer()
+        sync_file = dirq.add(sync_output)
+        if report:
+            report.add_output('sync', 1, 1, len(sync_output), timer() - t6)
+        print(f'Writing sync record to {config.output_path}/{sync_file}:')
+        print('--------------------------------\n' + sync_output + '--------------------------------')
+    return n_summaries + len(site_jobs)
+
+# Writes records to the message queue on local filesystem, packing up to 'batch_size' records into each message (queue element).
+# APEL messages can contain multiple records after the header line, each terminated by '%%'.
+# Writing many records per element saves a file creation and rename per record, and results in fewer messages for ssmsend to send.
+class RecordWriter:
+    def __init__(self, output_path, header, batch_size=1, echo=False):
+        self.output_path = output_path
+        self.dirq = QueueSimple(str(output_path))
+        self.header = header
+        self.batch_size = batch_size
+        self.echo = echo
+        self.pending = []
+        self.n_records = 0
+        self.n_messages = 0
+        self.n_bytes = 0
+        # Time spent writing to the queue
+        self.seconds = 0
+
+    def add(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        output = self.header + ''.join(self.pending)
+        t1 = timer()
+        record_file = self.dirq.add(output)
+        self.seconds += timer() - t1
+        self.n_records += len(self.pending)
+        self.n_messages += 1
+        self.n_bytes += len(output)
+        if self.echo:
+            print(f'Writing {len(self.pending)} record(s) to {self.output_path}/{record_file}:')
+            print('--------------------------------\n' + output + '--------------------------------')
+        self.pending = []
+
+def record_individual_period(config, table, report=None, published=None):
+    """ Record each pod in the configured namespaces over the summarized period.
     Assumes each pod ran once and terminated upon completion.
+    If a PublishedIndex is given, pods that it has with the same end time are skipped, and the pods written are added to it.
+    Returns the number of records written, and adds them to the PeriodReport if given.
     """
-    # Pivot records from {'data_type':{'pod_name':value}} to {'pod_name':{'data_type':value}}
-    per_pod_records = {}
-    for data_type, records in results.items():
-        for pod, val in records.items():
-            if not pod in per_pod_records:
-                per_pod_records[pod] = {}
-            per_pod_records[pod][data_type] = val
-    
-    dirq = QueueSimple(str(config.output_path))
+    sites = {namespace: config.site_name_for(namespace) for namespace in config.namespaces}
+    vos = {namespace: config.vo_name_for(namespace) for namespace in config.namespaces}
+    starttime = table.column('starttime')
+    endtime = table.column('endtime')
+
+    t4 = timer()
+    writer = RecordWriter(config.output_path, INDIVIDUAL_HEADER, batch_size=config.records_per_message, echo=config.echo_records)
     skipped_records = 0
-    for pod_name, records in per_pod_records.items():
-        # Only report on pods that have completed. Running pods won't have an endtime
-        if not ('starttime' in records and 'endtime' in records):
-            continue
+    already_published = 0
+    republished = 0
+    # (pod, end time) of the records written, added to the index once they are all in the output queue
+    new_published = []
+    # Other periods of the run may be using the index concurrently, and must not publish the same pods
+    with published.lock if published else contextlib.nullcontext():
+        # Pods are keyed by (namespace, pod) or, with the range collection engine, (namespace, pod, uid)
+        for row, (namespace, pod_name, *_) in enumerate(table.pods):
+            # Only report on pods that have completed. Running pods won't have an endtime
+            if math.isnan(starttime[row]) or math.isnan(endtime[row]):
+                continue
 
-        # If we can't determine the processor count for a pod, skip it with a warning
-        processors = records.get('cores', 0) or config.processors
-        if not processors:
-            skipped_records += 1
-            continue
+            if published:
+                published_end = published.published_end(table.pods[row])
+                if published_end == endtime[row]:
+                    already_published += 1
+                    continue
+
+            # If we can't determine the processor count for a pod, skip it with a warning
+            processors = table.get('cores', row, 0) or config.processors
+            if not processors:
+                skipped_records += 1
+                continue
+
+            writer.add(individual_record(
+                config,
+                pod_name,
+                table.get('memory', row, 0),
+                processors,
+                endtime[row] - starttime[row],
+                table.get('cpuusage', row, 0),
+                starttime[row],
+                endtime[row],
+                site_name=sites.get(namespace),
+                vo_name=vos.get(namespace)))
+            if published:
+                new_published.append((table.pods[row], endtime[row]))
+                if published_end is not None:
+                    # Most likely the pod name was reused by a new pod
+                    republished += 1
+        writer.flush()
+        if published:
+            published.add(new_published)
+    t5 = timer()
+    print(f'Wrote {writer.n_records} individual records in {writer.n_messages} messages ({writer.n_bytes} bytes) to {config.output_path} in {t5 - t4} s.')
+    if published:
+        print(f'Skipped {already_published} pods that were already published with the same end time. '
+              f'{republished} of the pods written had been published before with a different end time.')
+    if report:
+        report.add_output('individual', writer.n_records, writer.n_messages, writer.n_bytes, writer.seconds, already_published)
 
-        individual_output = individual_message(
-            config, 
-            pod_name,
-            records.get('memory', 0),
-            processors,
-            records['endtime'] - records['starttime'],
-            records.get('cpuusage', 0),
-            records['starttime'],
-            records['endtime'])
-        record_file = dirq.add(individual_output)
-        print(f'Writing individual record to {config.output_path}/{record_file}:')
-        print('--------------------------------\n' + individual_output + '--------------------------------')
-    
     if skipped_records > 0:
         print(f"WARNING: Skipped {skipped_records} records due to missing processor count. "
                "Please set pod resource requests or specify the PROCESSORS config var.")
+    return writer.n_records
+
+# Run a single query and return its results as a dict of {column: {key: value}}, where the keys are (namespace, pod) or for the
+# SERIES_COLUMNS, the key of each series (see result_key). Safe to call from worker threads.
+# There is one column named after the query, or for the fused query, one column for each of the queries it combines.
+# If 'stream' is true, the response is decoded as it is received,
+# so the full list of results (with all their labels) never needs to be held in memory.
+# If a PeriodReport is given, the query is recorded in it.
+def run_query(prom, query_name, query_string, params, stream=False, report=None):
+    # Each raw_result is a list (or generator) of dicts. Each dict represents an individual data point, and contains:
+    # 'metric': a dict of one or more key-value pairs of labels, one of which is the pod name.
+    # 'value': a list in which the 0th element is the timestamp of the value, and 1th element is the actual value we're interested in.
+    print(f'Executing {query_name} query: {query_string}')
+    t1 = timer()
+    stats = {}
+    if stream:
+        raw_result = prom.stream_query(query=query_string, params=params, stats=stats)
+    else:
+        raw_result = prom.custom_query(query=query_string, params=params, stats=stats)
+    t2 = timer()
+    results = {}
+    duplicates = {}
+    n_results = 0
+    if query_name in ('fused', 'summary'):
+        for column, pod, value in (rearrange_fused if query_name == 'fused' else rearrange_summary)(raw_result):
+            result = results.setdefault(column, {})
+            if pod in result:
+                count_duplicate(duplicates, column, result[pod], value)
+            result[pod] = value
+            n_results += 1
+    else:
+        result = results[query_name] = {}
+        for pod, value in rearrange(query_name, raw_result):
+            if pod in result:
+                count_duplicate(duplicates, query_name, result[pod], value)
+            result[pod] = value
+            n_results += 1
+    t3 = timer()
+    n_items = sum(len(result) for result in results.values())
+    print(f'{query_name} query finished in {t2 - t1} s, processed in {t3 - t2} s. Got {n_items} items from {n_results} results. Peak RAM usage: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}K.')
+    report_duplicates(query_name, duplicates)
+    if report:
+        report.add_query(query_name, t2 - t1, t3 - t2, stats['bytes'], n_items, time=params.get('time'),
+                         duplicates=sum(n for n, _ in duplicates.values()))
+    return results
+
+# Columns that have a single series per pod, so that duplicate results for a pod key mean that a pod name was reused during the query
+# window (a new pod with the same name, e.g. a job retried or a StatefulSet pod recreated), or that the series are duplicated
+# (e.g. by several kube-state-metrics instances). Other queries, such as cores, have a series per container, so duplicates are expected.
+POD_COLUMNS = ('starttime', 'endtime')
+
+# Count a result for a key that already has one, in 'duplicates': {column: [duplicates, conflicts]},
+# where conflicts are the duplicates with a different value. Only the last result of each key is kept.
+def count_duplicate(duplicates, column, previous, value):
+    counts = duplicates.setdefault(column, [0, 0])
+    counts[0] += 1
+    if previous != value:
+        counts[1] += 1
+
+# Print a summary of the duplicates counted by count_duplicate, as a warning if there are conflicting results for a POD_COLUMNS column.
+def report_duplicates(query_name, duplicates):
+    if not duplicates:
+        return
+    details = ', '.join(f'{column}: {n} ({conflicts} with a different value)' for column, (n, conflicts) in duplicates.items())
+    if any(conflicts for column, (_, conflicts) in duplicates.items() if column in POD_COLUMNS):
+        print(f'WARNING: {query_name} query returned more than one result for the same pod, probably because pod names were reused '
+              f'within the query window. Only one of them is used for each pod. Duplicates by column: {details}')
+    else:
+        print(f'{query_name} query returned duplicate results for some pods (e.g. one per container), only one of each is used: {details}')
+
+# Run a range query over one chunk of the window for the range collection engine, and return its results reduced to
+# a dict of {column: {(namespace, pod, uid): value}} (or the key of each series) by rearrange_range. Safe to call from worker threads.
+def run_range_query(prom, query_name, query_string, start_time, end_time, step, params, stream=False, report=None):
+    print(f'Executing {query_name} range query from {start_time.isoformat()} to {end_time.isoformat()}: {query_string}')
+    t1 = timer()
+    stats = {}
+    if stream:
+        raw_result = prom.stream_query_range(query=query_string, start_time=start_time, end_time=end_time, step=step, params=params, stats=stats)
+    else:
+        raw_result = prom.custom_query_range(query=query_string, start_time=start_time, end_time=end_time, step=step, params=params, stats=stats)
+    t2 = timer()
+    results = {}
+    duplicates = {}
+    n_results = 0
+    for column, pod, value in rearrange_range(query_name, raw_result):
+        result = results.setdefault(column, {})
+        if pod in result:
+            count_duplicate(duplicates, column, result[pod], value)
+        result[pod] = value
+        n_results += 1
+    t3 = timer()
+    print(f'{query_name} range query finished in {t2 - t1} s, processed in {t3 - t2} s. Got {n_results} items. Peak RAM usage: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}K.')
+    report_duplicates(query_name, duplicates)
+    if report:
+        report.add_query(query_name, t2 - t1, t3 - t2, stats['bytes'], n_results, start=start_time.isoformat(), end=end_time.isoformat(),
+                         duplicates=sum(n for n, _ in duplicates.values()))
+    return results
+
+# Split the query window that ends at 'instant' and goes back 'range_sec' seconds into contiguous shards of at most
+# 'shard_sec' seconds each. Returns a list of (instant, range_sec) tuples, latest shard first.
+# Range vector selectors cover (t - range, t], so the shards exactly cover the same samples as the whole window.
+def get_shards(instant, range_sec, shard_sec):
+    if not shard_sec or shard_sec >= range_sec:
+        return [(instant, range_sec)]
+    shards = []
+    remaining = range_sec
+    shard_end = instant
+    while remaining > 0:
+        shard_range = min(shard_sec, remaining)
+        shards.append((shard_end, shard_range))
+        shard_end = shard_end - datetime.timedelta(seconds=shard_range)
+        remaining -= shard_range
+    return shards
+
+# Run all the queries over the window ending at 'instant' and going back 'range_sec' seconds, using the given thread pool,
+# and merge the results into 'table'. If QUERY_SHARD_SEC is set (or with ADAPTIVE_QUERIES, if the QueryScheduler expects the queries
+# to take too long otherwise) the window is split into shards and each shard is queried separately.
+# Results are merged keeping the largest value of each pod (see merge_table). The queries select constant metrics (start/completion
+# times, resource requests) with max_over_time, so the max across shards (or across a cached table and the time since it was saved)
+# is what the query over the whole window would give. CPU usage is a cumulative counter per container, whose final value is in
+# the shard in which the container ended, so it is merged per series and only then summed per pod (see sum_series).
+def query_window(config, prom, pool, instant, range_sec, table, report=None, scheduler=None):
+    scheduler = scheduler or make_scheduler(config)
+    recording_rules = use_recording_rules(config, prom, instant, range_sec)
+    query_names = list(vars(make_queries(config, queryRange='RANGE', recording_rules=recording_rules)))
+    shard_sec = config.query_shard_sec or scheduler.shard_sec([query_key(name, recording_rules) for name in query_names], range_sec)
+    shards = get_shards(instant, range_sec, shard_sec)
+    if len(shards) > 1:
+        print(f'Splitting {range_sec} s query window into {len(shards)} shards of up to {shard_sec} s.')
+
+    futures = []
+    for shard_instant, shard_range in shards:
+        for query_name in query_names:
+            futures.append((query_name, pool.submit(run_scheduled_query, config, prom, scheduler, query_name, shard_instant, shard_range,
+                                                    recording_rules, report)))
+
+    # result() re-raises any exception from the worker thread, so a failed query still aborts the period
+    for i, (query_name, future) in enumerate(futures):
+        merge_table(table, future.result())
+        # drop the per-query dicts as soon as they have been merged
+        futures[i] = None
+    sum_series(table)
+    if config.fused_queries:
+        derive_cputime(table)
+    return table
+
+# Merge the results of a query (as returned by run_query or run_range_query) into a table, keeping the largest value of each pod,
+# or of each series for the SERIES_COLUMNS, which are merged into the per-series table.
+def merge_table(table, results):
+    for column, result in results.items():
+        (table.series_table() if column in SERIES_COLUMNS else table).merge_max(column, result.items())
+
+# Sum the per-series results of a table into the pod columns of SERIES_COLUMNS. A pod keeps its value if it is larger.
+# The series of each pod are summed with fsum, so the result does not depend on the order in which they were merged.
+def sum_series(table):
+    if table.series is None:
+        return
+    n_labels = len(SERIES_LABELS)
+    for series_column, column in SERIES_COLUMNS.items():
+        if series_column not in table.series.columns:
+            continue
+        values = {}
+        for key, value in zip(table.series.pods, table.series.column(series_column)):
+            if value == value:
+                values.setdefault(key[:-n_labels], []).append(value)
+        table.merge_max(column, ((pod, math.fsum(pod_values)) for pod, pod_values in values.items()))
+
+# Return the key of a query in the QueryHistory. Queries of the recorded series take much less time than those of the raw series.
+def query_key(query_name, recording_rules=False):
+    return query_name + ('/rules' if recording_rules else '')
+
+# Merge the results of a query over the second of two parts of a window (as returned by run_query) into those of the first,
+# keeping the largest value of each pod (or series), as for shards. Returns the merged results.
+def merge_results(results, other):
+    for column, other_result in other.items():
+        result = results.setdefault(column, {})
+        for pod, value in other_result.items():
+            if not (pod in result and result[pod] >= value):
+                result[pod] = value
+    return results
+
+# Run one of the queries of make_queries over the window ending at 'instant' and going back 'range_sec' seconds, with the timeout,
+# retries and splitting of the QueryScheduler, and return its results as run_query does.
+# If the window has to be split, each half is queried in the same way (so it may be split again), and the results are merged.
+def run_scheduled_query(config, prom, scheduler, query_name, instant, range_sec, recording_rules=False, report=None, deadline=None):
+    def attempt(timeout):
+        query_string = vars(make_queries(config, queryRange=f'{range_sec}s', recording_rules=recording_rules))[query_name]
+        params = {'time': instant.isoformat(), 'timeout': f'{timeout}s'}
+        return run_query(prom, query_name, query_string, params, config.stream_queries, report)
+
+    def split(deadline):
+        half = range_sec // 2
+        results = run_scheduled_query(config, prom, scheduler, query_name, instant, half, recording_rules, report, deadline)
+        return merge_results(results, run_scheduled_query(config, prom, scheduler, query_name, instant - datetime.timedelta(seconds=half),
+                                                          range_sec - half, recording_rules, report, deadline))
+
+    return scheduler.run(query_key(query_name, recording_rules), range_sec, attempt, split, deadline)
+
+# Like run_scheduled_query, for a range query of the range collection engine evaluated every 'step' seconds at 'n_steps' times,
+# the last of which is 'end_time'. A split keeps the evaluation times, so the halves line up with the other chunks.
+def run_scheduled_range_query(config, prom, scheduler, query_name, query_string, end_time, n_steps, step, report=None, deadline=None):
+    def attempt(timeout):
+        start_time = end_time - datetime.timedelta(seconds=(n_steps - 1) * step)
+        return run_range_query(prom, query_name, query_string, start_time, end_time, step, {'timeout': f'{timeout}s'},
+                               config.stream_queries, report)
+
+    def split(deadline):
+        n_later = n_steps // 2
+        results = run_scheduled_range_query(config, prom, scheduler, query_name, query_string, end_time, n_later, step, report, deadline)
+        return merge_results(results, run_scheduled_range_query(config, prom, scheduler, query_name, query_string,
+                                                                end_time - datetime.timedelta(seconds=n_later * step), n_steps - n_later, step,
+                                                                report, deadline))
+
+    return scheduler.run('range/' + query_name, n_steps * step, attempt, split if n_steps > 1 else None, deadline)
+
+# Create the QueryScheduler for the configuration, with the given QueryHistory if any.
+def make_scheduler(config, history=None):
+    return QueryScheduler(config.query_timeout_sec, retries=config.query_retries, backoff_sec=config.query_retry_backoff_sec,
+                          split_min_sec=config.query_split_min_sec, history=history, budget_sec=config.query_budget_sec)
+
+# Return whether the series of all the RECORDING_RULE_METRICS exist near the start and at the end of the window ending at 'instant'
+# and going back 'range_sec' seconds, i.e. the recording rules were already in place at the start of the window and still are.
+def recording_rules_available(prom, instant, range_sec, timeout):
+    query = f'count by (__name__) ({{__name__=~"{"|".join(RECORDING_RULE_METRICS.values())}"}})'
+    # Allow a few minutes after the start for the first evaluation of the rules
+    for time in (instant - datetime.timedelta(seconds=max(0, range_sec - 300)), instant):
+        result = prom.custom_query(query=query, params={'time': time.isoformat(), 'timeout': timeout})
+        if {item['metric'].get('__name__') for item in result} != set(RECORDING_RULE_METRICS.values()):
+            return False
+    return True
+
+# Return whether to use the recording rules for the window ending at 'instant' and going back 'range_sec' seconds, according to
+# RECORDING_RULES. In auto mode they are used if they are available for the whole window, e.g. not for a backfill of periods from
+# before the rules were installed. If that can't be determined, the raw queries are used.
+def use_recording_rules(config, prom, instant, range_sec):
+    if config.recording_rules != 'auto' or config.collection_engine != 'instant':
+        return config.recording_rules == 'true'
+    try:
+        available = recording_rules_available(prom, instant, range_sec, config.query_timeout)
+    except PrometheusQueryError as e:
+        print(f'WARNING: could not check for recording rules, using the raw queries: {e}')
+        return False
+    print(f"Recording rules are {'' if available else 'not '}available for the query window, using the {'recorded series' if available else 'raw queries'}.")
+    return available
+
+# Like query_window, for the range collection engine: query the window ending at 'instant' and going back 'range_sec' seconds
+# with range queries evaluated every RANGE_QUERY_STEP_SEC, split into chunks of about RANGE_QUERY_CHUNK_SEC, and merge the
+# largest value of each pod over the chunks into 'table'. Evaluations are aligned with 'instant', so the chunks of consecutive
+# windows (e.g. before and after a cache checkpoint) line up, and the last one is at 'instant' itself.
+def query_range_window(config, prom, pool, instant, range_sec, table, report=None, scheduler=None):
+    scheduler = scheduler or make_scheduler(config)
+    step = config.range_query_step_sec
+    queries = make_queries(config, queryRange=None)
+    # With ADAPTIVE_QUERIES, use smaller chunks if the QueryScheduler expects the queries to take too long otherwise
+    chunk_sec = min(config.range_query_chunk_sec, scheduler.shard_sec(['range/' + name for name in vars(queries)], range_sec) or math.inf)
+    # Whole number of steps per chunk, so that the evaluations of all chunks are evenly spaced
+    chunk_sec = max(step, chunk_sec - chunk_sec % step)
+    chunks = get_shards(instant, range_sec, chunk_sec)
+    print(f'Querying {range_sec} s window in {len(chunks)} chunks with a step of {step} s.')
+
+    futures = []
+    for chunk_end, chunk_range in chunks:
+        # Evaluations at chunk_end, chunk_end - step, ... cover (chunk_end - n_steps * step, chunk_end]
+        n_steps = math.ceil(chunk_range / step)
+        for query_name, query_string in vars(queries).items():
+            futures.append(pool.submit(run_scheduled_range_query, config, prom, scheduler, query_name, query_string, chunk_end, n_steps, step, report))
+
+    for i, future in enumerate(futures):
+        merge_table(table, future.result())
+        futures[i] = None
+    sum_series(table)
+    return table
+
+# Return a table for output from the results of the range collection engine, whose last evaluation was at 'instant'.
+# Pods that have no completion time but were no longer present at 'instant' were deleted before their completion time was
+# recorded (or were deleted while running), so they are given their last seen time as end time, which is accurate to within one step.
+# The cputime column is then derived as for the fused queries. 'table' itself is not modified, since it may be cached.
+def complete_range_table(table, instant):
+    instant_ts = instant.timestamp()
+    n_inferred = 0
+    endtime = array('d', table.column('endtime'))
+    for row, lastseen in enumerate(table.column('lastseen')):
+        if endtime[row] != endtime[row] and lastseen < instant_ts:
+            endtime[row] = lastseen
+            n_inferred += 1
+    if n_inferred:
+        print(f'Using the last seen time as the end time of {n_inferred} pods that were deleted without a recorded completion time.')
+    table = table.replace(endtime=endtime)
+    derive_cputime(table)
+    return table
+
+# Calculate the cputime column from the endtime, starttime and cores columns, in the same way as the cputime query.
+# Pods that are missing any of those (e.g. still running, so no end time) get NaN, like pods missing from the cputime query results.
+def derive_cputime(table):
+    table.columns['cputime'] = array('d', ((end - start) * cores for end, start, cores in
+                                           zip(table.column('endtime'), table.column('starttime'), table.column('cores'))))
+
+# Create the Prometheus client. It can be reused for any number of periods (and daemon cycles), so that HTTP connections are reused.
+def connect_prometheus(config):
+    # SSL generally not used for Prometheus access within a cluster
+    headers = {"Authorization": config.auth_header } if config.auth_header else None
+    # Allow a connection per concurrent query
+    pool_size = max(10, config.query_concurrency * config.period_concurrency)
+    return PrometheusClient(url=config.prometheus_server, headers=headers, verify=False,
+                            retries=config.prometheus_retries, pool_size=pool_size)
 
 # process a time period (do prom query, process data, write output)
-# takes a KAPELConfig object and one element of output from get_time_periods
+# takes a KAPELConfig object, one element of output from get_time_periods, and a Prometheus client from connect_prometheus.
+# Returns the number of records written. If a PeriodReport is given, the time and peak memory usage of each phase,
+# the queries and the records written are recorded in it. If a PublishedIndex is given, individual records are only written
+# for pods that are not in it (see record_individual_period). Queries are run by the QueryScheduler if given, otherwise by one
+# without a QueryHistory.
 # Remember Prometheus queries go backwards: the time instant is the end, go backwards from there.
-def process_period(config, period):
+def process_period(config, period, prom, report=None, published=None, scheduler=None):
+    phase = report.phase if report else lambda name: contextlib.nullcontext()
     period_start = period['instant'] + dateutil.relativedelta.relativedelta(seconds=-period['range_sec'])
     print(
         f"Processing year {period['year']}, month {period['month']}, "
         f"querying from {period['instant'].isoformat()} and going back {period['range_sec']} s to {period_start.isoformat()}."
     )
-    queries = QueryLogic(queryRange=(str(period['range_sec']) + 's'), namespace=config.namespace)
 
-    # SSL generally not used for Prometheus access within a cluster
-    # Docs on instant query API: https://prometheus.io/docs/prometheus/latest/querying/api/#instant-queries
-    headers = {"Authorization": config.auth_header } if config.auth_header else None
-    prom = PrometheusConnect(url=config.prometheus_server, disable_ssl=True, headers=headers)
-    prom_connect_params = {'time': period['instant'].isoformat(), 'timeout': config.query_timeout}
+    # Only the aggregate results are needed for summary records computed by Prometheus
+    scheduler = scheduler or make_scheduler(config)
+    if config.summarize_records and config.summary_engine == 'server':
+        with phase('query'):
+            summaries = server_summaries(config, prom, period, period_start, report, scheduler)
+        with phase('records'):
+            return record_summarized_period(config, period['year'], period['month'], summaries, report)
 
-    results = {}
-    # iterate over each query (cputime, starttime, endtime, cores) producing raw_results['cputime'] etc.
-    for query_name, query_string in vars(queries).items():
-        # Each of these raw_results is a list of dicts. Each dict in the list represents an individual data point, and contains:
-        # 'metric': a dict of one or more key-value pairs of labels, one of which is the pod name.
-        # 'value': a list in which the 0th element is the timestamp of the value, and 1th element is the actual value we're interested in.
-        print(f'Executing {query_name} query: {query_string}')
-        t1 = timer()
-        raw_result = prom.custom_query(query=query_string, params=prom_connect_params)
-        t2 = timer()
-        results[query_name] = dict(rearrange(raw_result))
-        t3 = timer()
-        print(f'Query finished in {t2 - t1} s, processed in {t3 - t2} s. Got {len(results[query_name])} items from {len(raw_result)} results. Peak RAM usage: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}K.')
+    # If the cache is enabled and has results for the start of this period, only query the time since the cache checkpoint.
+    # In gap mode periods are usually being republished to correct something, so bypass the cache unless configured otherwise.
+    cache = None
+    cached = None
+    table = PodTable()
+    query_range = period['range_sec']
+    if config.cache_enabled and (config.publishing_mode != 'gap' or config.cache_in_gap_mode):
+        cache = PeriodCache(config.cache_path, config.namespaces, period_start, query_signature(config))
+        with phase('cache_load'):
+            cached = cache.load(period['instant'])
+    if cached:
+        # The table includes the per-series CPU usage, so that the usage of containers that ended before the checkpoint is
+        # added to that of the containers found by the new queries (see sum_series).
+        checkpoint, table = cached
+        # Go back a bit further than the checkpoint, to pick up samples that were written to Prometheus late
+        # (e.g. completion times that were scraped or ingested after the previous run).
+        delta_start = max(period_start, checkpoint - datetime.timedelta(seconds=config.cache_overlap_sec))
+        query_range = int((period['instant'] - delta_start).total_seconds())
+        print(f'Using cached results up to {checkpoint.isoformat()}, querying only the last {query_range} s.')
+
+    # Run each query (cputime, starttime, endtime, cores, ...) producing a column of the table for each one.
+    # With QUERY_CONCURRENCY = 1 this is equivalent to running them serially in order.
+    # If the cache is already up to the end of the period (e.g. last month's period in auto mode, with CACHE_OVERLAP_SEC = 0),
+    # there is nothing to query: Prometheus rejects a range of 0 s.
+    if query_range > 0:
+        t0 = timer()
+        with phase('query'), concurrent.futures.ThreadPoolExecutor(max_workers=config.query_concurrency) as pool:
+            if config.collection_engine == 'range':
+                query_range_window(config, prom, pool, period['instant'], query_range, table, report, scheduler)
+            else:
+                query_window(config, prom, pool, period['instant'], query_range, table, report, scheduler)
+        print(f"All queries for year {period['year']}, month {period['month']} finished in {timer() - t0} s.")
+    else:
+        print('The cached results cover the whole period, not querying Prometheus.')
+
+    print(f'Got results for {len(table)} pods. Peak RAM usage: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}K.')
+    if cache and query_range > 0:
+        with phase('cache_save'):
+            cache.save(period['instant'], table)
+    if config.collection_engine == 'range':
+        table = complete_range_table(table, period['instant'])
 
     if config.summarize_records:
-        record_summarized_period(config, period_start, period['year'], period['month'], results)
+        summaries = summarize_groups(config, table, period_start)
+        if config.summary_engine == 'verify':
+            with phase('verify'):
+                compare_summaries(summaries, server_summaries(config, prom, period, period_start, report, scheduler))
+        with phase('records'):
+            return record_summarized_period(config, period['year'], period['month'], summaries, report)
+    with phase('records'):
+        return record_individual_period(config, table, report, published)
+
+# The APEL message types that KAPEL writes (see summary_message, individual_record and sync_message), by header line,
+# with the fields that manually-defined records of that type must have, and the fields that must be numbers if present.
+# Other fields are allowed, since APEL accepts more optional fields than KAPEL writes.
+# https://wiki.egi.eu/wiki/APEL/MessageFormat
+MESSAGE_FORMATS = {
+    'APEL-summary-job-message: v0.2': {
+        'required': ('Site', 'Month', 'Year', 'SubmitHost', 'WallDuration', 'CpuDuration', 'NumberOfJobs'),
+        'numeric': ('Month', 'Year', 'ServiceLevel', 'WallDuration', 'CpuDuration', 'NumberOfJobs', 'Processors', 'NodeCount',
+                    'EarliestEndTime', 'LatestEndTime'),
+    },
+    INDIVIDUAL_HEADER.strip(): {
+        'required': ('Site', 'SubmitHost', 'LocalJobId', 'WallDuration', 'CpuDuration', 'StartTime', 'EndTime'),
+        'numeric': ('WallDuration', 'CpuDuration', 'MemoryVirtual', 'Processors', 'NodeCount', 'StartTime', 'EndTime'),
+    },
+    'APEL-sync-message: v0.1': {
+        'required': ('Site', 'SubmitHost', 'NumberOfJobs', 'Month', 'Year'),
+        'numeric': ('NumberOfJobs', 'Month', 'Year'),
+    },
+}
+
+# Read a file of APEL messages one line at a time, and yield (header, lines, line number) for each record, where 'lines' are the
+# "Key: value" lines of the record and the line number is that of its first line. A file may contain several messages, each
+# starting with its header line. Problems with the structure of the file are yielded as (None, error message, line number).
+# Every line read is also added to 'digest' (a hashlib object) if given.
+def iter_manual_records(path, digest=None):
+    header = None
+    lines = []
+    first_line = None
+    with open(path, 'rb') as f:
+        for line_number, raw_line in enumerate(f, 1):
+            if digest:
+                digest.update(raw_line)
+            line = raw_line.decode('utf-8', errors='replace').strip()
+            if not line:
+                continue
+            if not lines and line in MESSAGE_FORMATS:
+                header = line
+            elif header is None:
+                yield None, f'expected one of the message headers {", ".join(MESSAGE_FORMATS)}, got {line!r}', line_number
+                return
+            elif line == '%%':
+                yield header, lines, first_line
+                lines = []
+            else:
+                if not lines:
+                    first_line = line_number
+                lines.append(line)
+    if header is None:
+        yield None, 'no records found', 0
+    elif lines:
+        yield None, 'the last record is not terminated by %%', first_line
+
+# Return a list of problems with a record of the given message type, which is empty if the record is valid.
+def validate_record(header, lines):
+    fields = {}
+    problems = []
+    for line in lines:
+        key, sep, value = line.partition(':')
+        key, value = key.strip(), value.strip()
+        if not sep or not key or not value:
+            problems.append(f'invalid line {line!r}, expected "Key: value"')
+        elif key in fields:
+            problems.append(f'duplicate field {key}')
+        fields[key] = value
+    message_format = MESSAGE_FORMATS[header]
+    for key in message_format['required']:
+        if key not in fields:
+            problems.append(f'missing field {key}')
+    for key in message_format['numeric']:
+        if key in fields:
+            try:
+                if not math.isfinite(float(fields[key])):
+                    raise ValueError
+            except ValueError:
+                problems.append(f'field {key} is not a number: {fields[key]!r}')
+    return problems
+
+# Publish manually-defined records, from the manual configmap.
+# All the files are validated first (streaming through them, so they are never held in memory), and nothing is published unless
+# every record is valid. Then the records of each file are written directly to the output queue, packed into messages of up to
+# RECORDS_PER_MESSAGE records of the same type, and a marker named after the hash of the file's content is written to
+# OUTPUT_PATH/manual. Files that already have a marker are skipped, so running again (e.g. on the next CronJob run before
+# the configmap has been emptied, or after a failure part way through) does not publish the same records twice.
+# This needs the output path to be on persistent storage to apply across runs (see dataVolumeClaim in the Helm chart).
+def publish_manual_records(cfg, manual_path, found_records):
+    print('Manually-defined records detected in ' + manual_path)
+    marker_dir = cfg.output_path / 'manual'
+    marker_dir.mkdir(parents=True, exist_ok=True)
+
+    todo = []
+    problems = []
+    for name in sorted(found_records):
+        path = join(manual_path, name)
+        digest = hashlib.sha256()
+        n_records = 0
+        for header, lines, line_number in iter_manual_records(path, digest):
+            if header is None:
+                problems.append(f'{path}:{line_number}: {lines}')
+                continue
+            n_records += 1
+            problems.extend(f'{path}:{line_number}: {problem}' for problem in validate_record(header, lines))
+        marker = marker_dir / f'{digest.hexdigest()}.json'
+        if marker.exists():
+            print(f'Skipping {path}: its records were already published according to {marker}')
+        else:
+            todo.append((path, marker, n_records))
+    if problems:
+        for problem in problems[:100]:
+            print(f'ERROR: {problem}')
+        raise ValueError(f'Found {len(problems)} problems with the manually-defined records in {manual_path}, so none were published.')
+
+    for path, marker, n_records in todo:
+        t1 = timer()
+        # One writer for each message type in the file
+        writers = {}
+        for header, lines, _ in iter_manual_records(path):
+            if header not in writers:
+                writers[header] = RecordWriter(cfg.output_path, header + '\n', batch_size=cfg.records_per_message, echo=cfg.echo_records)
+            writers[header].add('\n'.join(lines) + '\n%%\n')
+        for writer in writers.values():
+            writer.flush()
+        n_messages = sum(writer.n_messages for writer in writers.values())
+        marker.write_text(json.dumps({
+            'file': path, 'records': n_records, 'messages': n_messages,
+            'published': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        }))
+        print(f'Wrote {n_records} records from {path} in {n_messages} messages to {cfg.output_path} in {timer() - t1} s.')
+
+# Return the path of the file that marks a gap mode period as completed. The name depends on everything that affects the output
+# for the period (its time range, the namespaces, queries and type of records), so changing any of them means the period is redone.
+def period_marker(cfg, period):
+    key = json.dumps([period['instant'].isoformat(), period['range_sec'], cfg.namespaces, cfg.summarize_records, query_signature(cfg)])
+    name = f"{period['year']:04d}-{period['month']:02d}-{hashlib.sha256(key.encode()).hexdigest()[:16]}.json"
+    return cfg.output_path / 'backfill' / name
+
+# Pods are kept in the PublishedIndex until this many days before the start of the earliest period of a run, which allows for
+# completed pods remaining on the cluster (and so in the query results) for a long time after they finish.
+PUBLISHED_INDEX_RETENTION_DAYS = 31
+
+# Process one period for publish_periods, recording a completion marker in gap mode, and the outcome in the RunReport.
+# Returns (records written, seconds).
+def process_marked_period(cfg, period, prom, report, published=None, scheduler=None):
+    period_report = report.period(period)
+    t1 = timer()
+    try:
+        n_records = process_period(config=cfg, period=period, prom=prom, report=period_report, published=published, scheduler=scheduler)
+    except Exception as e:
+        period_report.status = 'failed'
+        period_report.error = f'{type(e).__name__}: {e}'
+        raise
+    period_report.status = 'completed'
+    seconds = timer() - t1
+    if cfg.publishing_mode == 'gap':
+        marker = period_marker(cfg, period)
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.write_text(json.dumps({
+            'year': period['year'], 'month': period['month'], 'instant': period['instant'].isoformat(), 'range_sec': period['range_sec'],
+            'records': n_records, 'seconds': round(seconds, 3),
+            'completed': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        }))
+    return n_records, seconds
+
+# Query and publish all the time periods for the configured publishing mode, with up to PERIOD_CONCURRENCY periods at a time.
+# A failed period does not stop the others; the failures are reported (and raised) at the end.
+# In gap mode, completed periods are marked in the output path and (unless BACKFILL_RESUME is false) skipped by subsequent runs,
+# so that a long backfill which fails part way through can be resumed.
+# In auto mode with PUBLISHED_INDEX, individual records are only written for pods that were not already published by a previous run.
+# With ADAPTIVE_QUERIES, the time taken by each query is added to the QueryHistory, which is saved for the next run.
+# Afterwards, a report of the run is written and exported according to the configuration (see emit_report).
+def publish_periods(cfg, prom):
+    report = RunReport()
+    history = QueryHistory(cfg.query_history_path) if cfg.adaptive_queries else None
+    try:
+        run_periods(cfg, prom, report, make_scheduler(cfg, history))
+    finally:
+        report.finish()
+        if history:
+            history.save()
+        emit_report(cfg, report)
+
+def run_periods(cfg, prom, report, scheduler=None):
+    periods = get_time_periods(cfg.publishing_mode, start_time=cfg.query_start, end_time=cfg.query_end)
+    print('time periods:')
+    print(periods)
+
+    # Gap mode is normally used to republish periods, so it writes every record regardless of the index.
+    if cfg.published_index and cfg.publishing_mode == 'auto' and not cfg.summarize_records:
+        with PublishedIndex(cfg.published_index_path) as published:
+            # Pods that ended long before the earliest period can't still be in the query results
+            earliest = min(p['instant'] - datetime.timedelta(seconds=p['range_sec']) for p in periods)
+            pruned = published.prune((earliest - datetime.timedelta(days=PUBLISHED_INDEX_RETENTION_DAYS)).timestamp())
+            print(f'Using the index of {published.size()} published pods in {cfg.published_index_path} ({pruned} old entries removed).')
+            process_periods(cfg, prom, report, periods, published, scheduler)
     else:
-        record_individual_period(config, results)
+        process_periods(cfg, prom, report, periods, scheduler=scheduler)
+
+# Process the periods for run_periods, skipping those already completed in gap mode.
+def process_periods(cfg, prom, report, periods, published=None, scheduler=None):
+    todo = []
+    skipped = 0
+    for p in periods:
+        if cfg.publishing_mode == 'gap' and cfg.backfill_resume and period_marker(cfg, p).exists():
+            print(f"Skipping year {p['year']}, month {p['month']}: already completed according to {period_marker(cfg, p)}")
+            skipped += 1
+        else:
+            todo.append(p)
+    report.skipped = skipped
+
+    t0 = timer()
+    completed = 0
+    n_records = 0
+    failed = []
+    # Each period still runs its own queries with QUERY_CONCURRENCY. With PERIOD_CONCURRENCY = 1 periods are processed in order.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=cfg.period_concurrency) as pool:
+        futures = {pool.submit(process_marked_period, cfg, p, prom, report, published, scheduler): p for p in todo}
+        for future in concurrent.futures.as_completed(futures):
+            p = futures[future]
+            try:
+                period_records, seconds = future.result()
+            except Exception as e:
+                print(f"ERROR: failed to process year {p['year']}, month {p['month']}: {type(e).__name__}: {e}")
+                failed.append((p, e))
+                continue
+            completed += 1
+            n_records += period_records
+            print(f"Progress: {completed + len(failed)}/{len(todo)} periods processed: year {p['year']}, month {p['month']} "
+                  f"wrote {period_records} records in {seconds:.1f} s.")
+
+    elapsed = timer() - t0
+    rate = f'{completed / elapsed * 3600:.1f} periods/hour, {n_records / elapsed:.1f} records/s' if elapsed > 0 else 'n/a'
+    print(f'Processed {len(periods)} periods in {elapsed:.1f} s: {completed} completed, {skipped} skipped, {len(failed)} failed. '
+          f'Wrote {n_records} records ({rate}).')
+    if failed:
+        # Raise the first error so the run fails (and can be retried, skipping the completed periods)
+        raise failed[0][1]
+
+# Write the RunReport as JSON to the output path (RUN_REPORT), and its metrics to METRICS_TEXTFILE and METRICS_PUSHGATEWAY if set.
+# The records have already been written by then, so a failure here is only reported.
+def emit_report(cfg, report):
+    try:
+        if cfg.run_report:
+            report.write(cfg.output_path)
+        if cfg.metrics_textfile:
+            report.write_textfile(cfg.metrics_textfile)
+        if cfg.metrics_pushgateway:
+            report.push(cfg.metrics_pushgateway, cfg.submit_host)
+    except Exception as e:
+        print(f'WARNING: failed to write the run report or metrics: {type(e).__name__}: {e}')
 
-def main(envFile):
+def main(envFile, daemon=False, profile=False):
     print(f'Starting KAPEL processor: {__file__} with envFile {envFile} at {datetime.datetime.now(tz=datetime.timezone.utc).isoformat()}')
     cfg = KAPELConfig(envFile)
+    if profile:
+        with profiled(cfg.output_path):
+            run(cfg, daemon)
+    else:
+        run(cfg, daemon)
+
+def run(cfg, daemon):
+    prom = connect_prometheus(cfg)
+
+    if daemon:
+        # Keep running and publish periodically, reusing the config, Prometheus connections and cache between cycles.
+        # Manually-defined records are a one-off correction, so they are only handled by normal (non-daemon) runs.
+        run_daemon(lambda: publish_periods(cfg, prom), cfg.daemon_interval_sec, cfg.daemon_status_port)
+        return
 
     # look for manually-defined records, from the manual configmap
     manual_path = '/srv/manual'
     found_records = [ f for f in listdir(manual_path) if isfile(join(manual_path, f))]
-    
-    if found_records:
-      print('Manually-defined records detected in ' + manual_path)
-      # Because dirq.add_path uses hard links, can't cross filesystems, have to copy files
-      dest_dir = join(cfg.output_path, 'manual')
-      mkdir(dest_dir)
-      dirq = QueueSimple(str(cfg.output_path))
-      for record in found_records:
-        src_file = join(manual_path, record)
-        dst_file = join(dest_dir, record)
-        print(f'Copying file from {src_file} to {dst_file}')
-        copyfile(src_file, dst_file)
-        added_file = join(cfg.output_path, dirq.add_path(dst_file))
-        print(f'Adding record from {dst_file} to {added_file}:')
-        print('--------------------------------\n' + Path(added_file).read_text() + '--------------------------------')
 
+    if found_records:
+      publish_manual_records(cfg, manual_path, found_records)
     else:
       # No manual records detected, do normal procedure
-      periods = get_time_periods(cfg.publishing_mode, start_time=cfg.query_start, end_time=cfg.query_end)
-      print('time periods:')
-      print(periods)
-
-      for p in periods:
-          process_period(config=cfg, period=p)
+      publish_periods(cfg, prom)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract Kubernetes job accounting data from Prometheus and prepare it for APEL publishing.")
-    # This should be the only CLI argument, since all other config should be specified via env.
+    # Other than the mode of operation, all config should be specified via env.
     parser.add_argument("-e", "--env-file", default=None, help="name of file containing environment variables for configuration")
+    parser.add_argument("--daemon", action="store_true", help="keep running and publish every DAEMON_INTERVAL_SEC seconds, instead of once")
+    parser.add_argument("--profile", action="store_true", help="profile the run with cProfile and tracemalloc, writing the results to OUTPUT_PATH/profile")
     args = parser.parse_args()
-    main(args.env_file)
+    main(args.env_file, daemon=args.daemon, profile=args.profile)
@@ -0,0 +1,98 @@
+# Incremental checkpoint cache for KAPEL
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from KAPELTable import PodTable
+
+# Increment this if the format of cache files changes, so that old files are ignored.
+CACHE_VERSION = 4
+
+# Cache entries saved by this process, so that a long-running daemon doesn't need to re-read its own cache files.
+# Maps file path -> (modification time, signature, checkpoint, table). Only the most recent few entries are kept.
+MEMORY_ENTRIES = 4
+_memory = {}
+
+# The cache holds the merged per-pod query results for the part of a publishing period that has already been queried,
+# i.e. from the start of the period up to a checkpoint. On the next run, only the time since the checkpoint needs to be queried,
+# and the new results are merged into the cached ones in the same way as the results of query shards (see query_window in KAPEL.py):
+# by taking the max of each pod, since the queries select constant metrics with max_over_time, except for the CPU usage counters.
+# Those are kept per container series, because a container that ended before the checkpoint has no series after it, and summed
+# per pod after merging. There is one JSON file per set of namespaces and period, containing the PodTable with the results of
+# each query keyed by query name, including its per-series results.
+class PeriodCache:
+    def __init__(self, cache_path, namespaces, period_start, signature):
+        self.namespace = ','.join(namespaces)
+        self.period_start = period_start
+        # A hash of the query definitions. If the queries change, old cache entries no longer apply.
+        self.signature = signature
+        # Avoid overly long file names if there are many namespaces
+        name = namespaces[0] if len(namespaces) == 1 else 'namespaces-' + hashlib.sha256(self.namespace.encode()).hexdigest()[:16]
+        self.file = Path(cache_path) / f'{name}-{period_start.strftime("%Y-%m-%dT%H%M%S")}.json'
+
+    # Return (checkpoint, table) from the cache file, or None if there is no usable cache entry for a period ending at 'instant'.
+    def load(self, instant):
+        try:
+            mtime = self.file.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        entry = _memory.get(self.file)
+        if entry and entry[0] == mtime and entry[1] == self.signature:
+            _, _, checkpoint, table = entry
+            if self.check_checkpoint(checkpoint, instant):
+                return checkpoint, table
+            return None
+
+        try:
+            with open(self.file) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'WARNING: ignoring unreadable cache file {self.file}: {e}')
+            return None
+
+        if (data.get('version') != CACHE_VERSION or data.get('namespace') != self.namespace
+                or data.get('period_start') != self.period_start.isoformat() or data.get('signature') != self.signature):
+            print(f'Cache file {self.file} does not match the current period or queries, ignoring it.')
+            return None
+        checkpoint = datetime.datetime.fromisoformat(data['checkpoint'])
+        if not self.check_checkpoint(checkpoint, instant):
+            return None
+        return checkpoint, PodTable.from_dict(data['table'])
+
+    # The cached results must not include anything after the end of the period being processed,
+    # e.g. if the period is being reprocessed with an earlier end time.
+    def check_checkpoint(self, checkpoint, instant):
+        if checkpoint > instant or checkpoint <= self.period_start:
+            print(f'Cache checkpoint {checkpoint.isoformat()} is outside of the period being processed, ignoring it.')
+            return False
+        return True
+
+    # Atomically replace the cache file with the results table for the period up to 'checkpoint'.
+    def save(self, checkpoint, table):
+        data = {
+            'version': CACHE_VERSION,
+            'namespace': self.namespace,
+            'period_start': self.period_start.isoformat(),
+            'signature': self.signature,
+            'checkpoint': checkpoint.isoformat(),
+            'table': table.to_dict(),
+        }
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file in the same directory and rename it, so that a crash never leaves a partial cache file.
+        fd, tmp = tempfile.mkstemp(dir=self.file.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        _memory.pop(self.file, None)
+        _memory[self.file] = (self.file.stat().st_mtime_ns, self.signature, checkpoint, table)
+        while len(_memory) > MEMORY_ENTRIES:
+            del _memory[next(iter(_memory))]
+        print(f'Saved cache checkpoint {checkpoint.isoformat()} to {self.file}.')
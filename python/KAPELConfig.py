@@ -1,8 +1,12 @@
 # Configuration module for KAPEL
 
+import re
+
 from environs import Env
 from environs import EnvError
 
+from KAPELPrometheus import parse_duration
+
 # Read config settings from environment variables (and a named env file in CWD if specified),
 # do input validation, and return a config object. Note, if a '.env' file exists in CWD it will be used by default.
 class KAPELConfig:
@@ -21,7 +25,15 @@ class KAPELConfig:
         self.publishing_mode = env.str("PUBLISHING_MODE", "auto")
 
         # The Kubernetes namespace to query. Only pods in this namespace will be accounted.
-        self.namespace = env.str("NAMESPACE")
+        # Alternatively NAMESPACES can be a comma-separated list of namespaces, which are all queried at once and accounted separately.
+        # This is much less load on Prometheus than running a separate instance of KAPEL for each namespace.
+        # Spaces around the names are ignored, e.g. NAMESPACES="atlas-prod, belle".
+        self.namespaces = [namespace.strip() for namespace in env.list("NAMESPACES", []) if namespace.strip()]
+        if not self.namespaces:
+            self.namespaces = [env.str("NAMESPACE")]
+        for namespace in self.namespaces:
+            if not re.fullmatch(r'[a-z0-9]([-a-z0-9]*[a-z0-9])?', namespace):
+                raise ValueError(f'Invalid namespace name: {namespace}')
 
         self.summarize_records = env.bool("SUMMARIZE_RECORDS", True)
 
@@ -43,13 +55,157 @@ class KAPELConfig:
             self.query_start = None
             self.query_end = None
 
+        # In gap mode, a marker is written to the output path for each period that is completed, and periods that already have a marker
+        # (with the same time range, namespaces, queries and record type) are skipped, so that a long backfill can be resumed after a failure.
+        # This requires the output path to be on persistent storage (see dataVolumeClaim in the Helm chart).
+        # To republish completed periods, delete the markers in OUTPUT_PATH/backfill or set BACKFILL_RESUME to false.
+        self.backfill_resume = env.bool("BACKFILL_RESUME", True)
+
         # Timeout for the server to evaluate the query. Can take awhile for large-scale production use.
-        # Format: https://prometheus.io/docs/prometheus/latest/querying/basics/#time-durations
+        # Format: https://prometheus.io/docs/prometheus/latest/querying/basics/#time-durations, or a number of seconds.
+        # This is also the longest timeout used with ADAPTIVE_QUERIES.
         self.query_timeout = env.str("QUERY_TIMEOUT", "1800s")
+        self.query_timeout_sec = parse_duration(self.query_timeout)
+
+        # Number of times to retry a Prometheus request after a connection error or a 502 or 504 response, with exponential backoff.
+        self.prometheus_retries = env.int("PROMETHEUS_RETRIES", 3)
+
+        # Number of times to run a query again after it failed with an error that may be temporary (a timeout, a 5xx response,
+        # or a dropped connection), waiting QUERY_RETRY_BACKOFF_SEC seconds before the first retry and twice as long before each
+        # of the following ones. Each retry also has twice the timeout of the previous attempt (up to QUERY_TIMEOUT). A query that timed
+        # out with the full QUERY_TIMEOUT is not retried if its time range can be split (see QUERY_SPLIT_MIN_SEC), but split straight away.
+        self.query_retries = env.int("QUERY_RETRIES", 2)
+        self.query_retry_backoff_sec = env.int("QUERY_RETRY_BACKOFF_SEC", 30)
+        # If a query still fails, or fails because it would load too many samples, its time range is split in half and each half
+        # is queried separately (and split again if necessary), down to ranges of this many seconds. 0 disables splitting.
+        self.query_split_min_sec = env.int("QUERY_SPLIT_MIN_SEC", 3600)
+        # Optionally give up on a query after this many seconds in total, including its retries and the queries of the halves it was
+        # split into, so that a run can't take much longer than expected when Prometheus is busy. The default of 0 means no limit.
+        self.query_budget_sec = env.int("QUERY_BUDGET_SEC", 0)
+        if self.query_retries < 0 or self.query_retry_backoff_sec < 0 or self.query_split_min_sec < 0 or self.query_budget_sec < 0:
+            raise ValueError("QUERY_RETRIES, QUERY_RETRY_BACKOFF_SEC, QUERY_SPLIT_MIN_SEC and QUERY_BUDGET_SEC must not be negative")
+
+        # Whether to keep a history of how long each query takes, and use it to give each query a timeout of a few times its
+        # expected time (rather than always QUERY_TIMEOUT), so that a query that is stuck while Prometheus is busy is retried
+        # or split early, and to shard query windows (unless QUERY_SHARD_SEC is set) and range query chunks so that each query
+        # is expected to take at most a quarter of QUERY_TIMEOUT.
+        # The history is only kept between runs if its path is on persistent storage (see dataVolumeClaim in the Helm chart).
+        self.adaptive_queries = env.bool("ADAPTIVE_QUERIES", False)
+
+        # Whether to decode query responses from Prometheus incrementally as they are received, instead of loading the whole response
+        # into memory first. This greatly reduces peak memory usage for large namespaces.
+        self.stream_queries = env.bool("STREAM_QUERIES", False)
+
+        # Whether to fetch the start and end times, cores, memory and CPU usage of pods with a single fused query, and calculate
+        # cputime from them, instead of running a separate query for each. This reduces the work Prometheus has to do by roughly half.
+        self.fused_queries = env.bool("FUSED_QUERIES", False)
+
+        # Whether to query the pre-aggregated series of the KAPEL recording rules (see recordingRules in the Helm chart) instead of
+        # the raw cAdvisor and kube-state-metrics series, which is much faster: "true", "false", or "auto" (default) to use them when
+        # they have been recorded for the whole time window being queried, and otherwise fall back to the raw queries.
+        # Only applies to the instant collection engine, and not to the aggregate queries of SUMMARY_ENGINE server.
+        self.recording_rules = env.str("RECORDING_RULES", "auto").lower()
+        if self.recording_rules not in ("auto", "true", "false"):
+            raise ValueError(f'Invalid RECORDING_RULES: {self.recording_rules}')
+
+        # How to collect the pod data from Prometheus:
+        # "instant" (default): one instant query per metric, taking the max_over_time of each series over the whole period.
+        #   Pods must remain on the cluster in Completed state long enough for their completion time to be scraped.
+        # "range": range queries evaluated every RANGE_QUERY_STEP_SEC over the period, in chunks of RANGE_QUERY_CHUNK_SEC, which spreads
+        #   the load on Prometheus over many small queries. Pods are identified by UID, which requires kube-state-metrics v2 or later.
+        #   Pods deleted before their completion time was scraped are accounted with their last seen time as end time.
+        #   FUSED_QUERIES and QUERY_SHARD_SEC only apply to the instant engine.
+        self.collection_engine = env.str("COLLECTION_ENGINE", "instant")
+        if self.collection_engine not in ("instant", "range"):
+            raise ValueError(f'Invalid COLLECTION_ENGINE: {self.collection_engine}')
+        # Seconds between range query evaluations. This is the accuracy of the inferred end time of deleted pods.
+        self.range_query_step_sec = env.int("RANGE_QUERY_STEP_SEC", 600)
+        # Approximate length of the time range of each range query, in seconds. It is rounded down to a whole number of steps.
+        self.range_query_chunk_sec = env.int("RANGE_QUERY_CHUNK_SEC", 86400)
+        if self.range_query_step_sec < 1 or self.range_query_chunk_sec < 1:
+            raise ValueError("RANGE_QUERY_STEP_SEC and RANGE_QUERY_CHUNK_SEC must be at least 1")
+
+        # How to compute summary records (when SUMMARIZE_RECORDS is true):
+        # "pods" (default): from the results of each pod, which are downloaded from Prometheus.
+        # "server": with aggregate queries, so that Prometheus only returns a few numbers for each namespace. This does not use the
+        #   cache or QUERY_SHARD_SEC, since aggregates over different time windows can't be merged.
+        # "verify": both, checking that they agree. The records are written from the per-pod results, and any differences are logged.
+        # "server" and "verify" require COLLECTION_ENGINE to be "instant".
+        self.summary_engine = env.str("SUMMARY_ENGINE", "pods")
+        if self.summary_engine not in ("pods", "server", "verify"):
+            raise ValueError(f'Invalid SUMMARY_ENGINE: {self.summary_engine}')
+        if self.summary_engine != "pods" and self.collection_engine != "instant":
+            raise ValueError(f'SUMMARY_ENGINE {self.summary_engine} requires COLLECTION_ENGINE instant')
+
+        # Maximum number of Prometheus queries to run at the same time for a given time period.
+        # The default of 1 runs the queries serially. Higher values reduce wall time, at the cost of more concurrent load on Prometheus.
+        self.query_concurrency = env.int("QUERY_CONCURRENCY", 1)
+
+        # Maximum number of time periods (months) to process at the same time. The default of 1 processes periods serially.
+        # The total number of concurrent queries can be up to QUERY_CONCURRENCY * PERIOD_CONCURRENCY.
+        self.period_concurrency = env.int("PERIOD_CONCURRENCY", 1)
+        if self.query_concurrency < 1 or self.period_concurrency < 1:
+            raise ValueError("QUERY_CONCURRENCY and PERIOD_CONCURRENCY must be at least 1")
+
+        # Optionally split each query window into shards of this many seconds (e.g. 86400 for daily shards).
+        # Each shard is queried separately and the results are merged, which bounds the amount of data Prometheus needs
+        # to load for any single query. The per-pod results are merged by taking the max, and the CPU usage per container series
+        # before it is summed per pod, so that containers that ended in earlier shards are included.
+        # The default of 0 disables sharding.
+        self.query_shard_sec = env.int("QUERY_SHARD_SEC", 0)
+        if self.query_shard_sec < 0:
+            raise ValueError("QUERY_SHARD_SEC must not be negative")
 
         # Where to write the APEL message output.
         self.output_path = env.path("OUTPUT_PATH", "/srv/kapel")
 
+        # Number of individual job records to write in each APEL message when SUMMARIZE_RECORDS is false (and the maximum number
+        # of manually-defined records of the same type to write in each message).
+        # APEL accepts multiple records per message; larger values mean far fewer files to write and send.
+        # The default of 1 writes one message per record. Values up to 1000 are reasonable for ssmsend.
+        self.records_per_message = env.int("RECORDS_PER_MESSAGE", 1)
+        if self.records_per_message < 1:
+            raise ValueError("RECORDS_PER_MESSAGE must be at least 1")
+
+        # Whether to print the content of every individual job record message to stdout. This can produce a very large log.
+        self.echo_records = env.bool("ECHO_RECORDS", False)
+
+        # Whether to write a JSON report of each run (with the time, response size and number of results of each query, the time and
+        # peak memory usage of each phase, and the records written for each period) to OUTPUT_PATH/reports. The last 100 are kept.
+        self.run_report = env.bool("RUN_REPORT", True)
+        # Optionally write metrics of each run in the Prometheus text format to this file, e.g. for the node exporter textfile collector
+        # (the file name must end in .prom).
+        self.metrics_textfile = env.path("METRICS_TEXTFILE", None)
+        # Optionally push metrics of each run to this Prometheus Pushgateway URL, grouped by job "kapel" and instance SUBMIT_HOST.
+        self.metrics_pushgateway = env.str("METRICS_PUSHGATEWAY", None)
+
+        # Optionally cache the query results of each period, so that subsequent runs only need to query the time since the previous run.
+        # This is only useful if the cache path is on persistent storage (see dataVolumeClaim in the Helm chart).
+        self.cache_enabled = env.bool("CACHE_ENABLED", False)
+        # Where to store the cache files. By default a subdirectory of the output path, which is ignored by ssmsend.
+        self.cache_path = env.path("CACHE_PATH", self.output_path / "cache")
+        # How far before the cache checkpoint to start querying again, in seconds, to allow for metrics that arrive in Prometheus late.
+        self.cache_overlap_sec = env.int("CACHE_OVERLAP_SEC", 3600)
+        # Gap mode is normally used to republish periods from scratch, so the cache is bypassed unless this is set.
+        self.cache_in_gap_mode = env.bool("CACHE_IN_GAP_MODE", False)
+
+        # Whether to keep an index of the pods for which individual job records have been published (with their end times), and in auto
+        # mode only write records for pods that are not in it, or that now have a different end time (e.g. a reused pod name).
+        # Otherwise every run writes records again for all the completed pods still in the query window, which APEL deduplicates.
+        # This is only useful if the index is on persistent storage (see dataVolumeClaim in the Helm chart).
+        self.published_index = env.bool("PUBLISHED_INDEX", False)
+        # Where to store the index. By default a subdirectory of the output path, which is ignored by ssmsend.
+        self.published_index_path = env.path("PUBLISHED_INDEX_PATH", self.output_path / "published" / "index")
+
+        # Where to store the query history for ADAPTIVE_QUERIES. By default a subdirectory of the output path, which is ignored by ssmsend.
+        self.query_history_path = env.path("QUERY_HISTORY_PATH", self.output_path / "history" / "query-latency.json")
+
+        # Settings for daemon mode (KAPEL.py --daemon), where KAPEL keeps running and publishes periodically instead of running from a CronJob (see daemon.enabled in the Helm chart).
+        # Seconds between the start of each publishing cycle.
+        self.daemon_interval_sec = env.int("DAEMON_INTERVAL_SEC", 86400)
+        # Port on which to serve /healthz, /readyz and /status. 0 disables the status server.
+        self.daemon_status_port = env.int("DAEMON_STATUS_PORT", 8080)
+
         ## Info for APEL records, see https://wiki.egi.eu/wiki/APEL/MessageFormat
         # GOCDB site name
         self.site_name = env.str("SITE_NAME")
@@ -69,6 +225,14 @@ class KAPELConfig:
         # VO of jobs
         self.vo_name = env.str("VO_NAME")
 
+        # Optionally override the site name or VO for particular namespaces, with comma-separated lists of namespace=value pairs,
+        # e.g. NAMESPACE_VO_NAMES="atlas-prod=atlas,belle=belle". Namespaces not listed use SITE_NAME and VO_NAME.
+        self.namespace_site_names = {namespace.strip(): name.strip() for namespace, name in env.dict("NAMESPACE_SITE_NAMES", {}).items()}
+        self.namespace_vo_names = {namespace.strip(): name.strip() for namespace, name in env.dict("NAMESPACE_VO_NAMES", {}).items()}
+        for namespace in list(self.namespace_site_names) + list(self.namespace_vo_names):
+            if namespace not in self.namespaces:
+                raise ValueError(f'Namespace {namespace} has a site name or VO defined but is not one of the configured namespaces')
+
         # infrastructure info
         self.infrastructure_type = env.str("INFRASTRUCTURE_TYPE", "grid")
         self.infrastructure_description = env.str("INFRASTRUCTURE_DESCRIPTION", "APEL-KUBERNETES")
@@ -77,3 +241,16 @@ class KAPELConfig:
         # set a default of 0 here but see https://github.com/apel/apel/issues/241
         self.nodecount = env.int("NODECOUNT", 0)
         self.processors = env.int("PROCESSORS", 0)
+
+    def site_name_for(self, namespace):
+        return self.namespace_site_names.get(namespace, self.site_name)
+
+    def vo_name_for(self, namespace):
+        return self.namespace_vo_names.get(namespace, self.vo_name)
+
+    # Return a dict of {(site name, VO name): [namespaces]}, i.e. which namespaces should be summarized together.
+    def namespace_groups(self):
+        groups = {}
+        for namespace in self.namespaces:
+            groups.setdefault((self.site_name_for(namespace), self.vo_name_for(namespace)), []).append(namespace)
+        return groups
@@ -0,0 +1,113 @@
+# Long-running daemon mode for KAPEL
+
+import datetime
+import json
+import signal
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from timeit import default_timer as timer
+
+def now():
+    return datetime.datetime.now(tz=datetime.timezone.utc).replace(microsecond=0)
+
+# Status of the daemon, shared between the scheduler and the status server.
+class DaemonStatus:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = now()
+        self.runs = 0
+        self.failures = 0
+        self.running = False
+        self.last_start = None
+        self.last_end = None
+        self.last_duration_sec = None
+        self.last_success = None
+        self.last_error = None
+        self.next_run = None
+
+    # The daemon is ready once a cycle has completed, as long as the most recent cycle did not fail.
+    def ready(self):
+        with self.lock:
+            return self.last_success is not None and self.last_error is None
+
+    def to_dict(self):
+        with self.lock:
+            status = dict(vars(self))
+        del status['lock']
+        return {key: value.isoformat() if isinstance(value, datetime.datetime) else value for key, value in status.items()}
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        status = self.server.status
+        if self.path == '/healthz':
+            self.reply(200, {'alive': True})
+        elif self.path == '/readyz':
+            ready = status.ready()
+            self.reply(200 if ready else 503, {'ready': ready})
+        elif self.path == '/status':
+            self.reply(200, status.to_dict())
+        else:
+            self.send_error(404)
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Don't fill the log with probe requests
+    def log_message(self, format, *args):
+        pass
+
+# Serve /healthz, /readyz and /status (JSON) on the given port in a background thread, e.g. for Kubernetes probes.
+def start_status_server(status, port):
+    server = ThreadingHTTPServer(('', port), StatusHandler)
+    server.daemon_threads = True
+    server.status = status
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Serving daemon status on port {port}.')
+    return server
+
+# Call run_cycle() immediately and then every interval_sec seconds (measured from the start of each cycle) until SIGTERM or SIGINT.
+# A failed cycle is logged and recorded in the status, and the next cycle still runs on schedule.
+def run_daemon(run_cycle, interval_sec, status_port=None):
+    status = DaemonStatus()
+    if status_port:
+        start_status_server(status, status_port)
+
+    stop = threading.Event()
+    def handle_signal(signum, frame):
+        print(f'Received signal {signum}, stopping after the current cycle.')
+        stop.set()
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    while not stop.is_set():
+        with status.lock:
+            status.running = True
+            status.last_start = now()
+        print(f'Starting daemon cycle {status.runs + 1} at {status.last_start.isoformat()}')
+        t1 = timer()
+        error = None
+        try:
+            run_cycle()
+        except Exception as e:
+            traceback.print_exc()
+            error = f'{type(e).__name__}: {e}'
+        duration = timer() - t1
+        with status.lock:
+            status.running = False
+            status.runs += 1
+            status.last_end = now()
+            status.last_duration_sec = round(duration, 3)
+            status.last_error = error
+            if error:
+                status.failures += 1
+            else:
+                status.last_success = status.last_end
+            status.next_run = status.last_start + datetime.timedelta(seconds=interval_sec)
+        print(f"Daemon cycle {'failed' if error else 'finished'} in {duration} s. Next cycle at {status.next_run.isoformat()}.")
+        stop.wait(max(0, interval_sec - duration))
@@ -0,0 +1,63 @@
+# Persistent index of published individual job records for KAPEL
+
+import dbm
+import struct
+import threading
+from pathlib import Path
+
+# End times are stored as 8-byte doubles
+END_FORMAT = struct.Struct('<d')
+
+# The index records the end time of every pod for which an individual job record has been published, keyed by the pod key
+# of the results table, i.e. (namespace, pod) or, with the range collection engine, (namespace, pod, uid).
+# In auto mode the same completed pods are found by every run until they leave the query window (and those that finish near
+# the end of a month are found by the queries for both months), so without the index their records are written again each time.
+# With it, only pods that were not published before, or were published with a different end time (e.g. a pod name that was reused
+# by a new pod), are written. It is a dbm database (normally gdbm or ndbm, which keep it on disk rather than in memory).
+# The index is shared by the periods of a run, which may be processed concurrently: hold 'lock' while checking and adding pods.
+class PublishedIndex:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = dbm.open(str(self.path), 'c')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    @staticmethod
+    def key(pod):
+        # Label values can't contain '/'
+        return '/'.join(pod).encode()
+
+    # Return the end time with which a pod was published, or None if it wasn't.
+    def published_end(self, pod):
+        value = self.db.get(self.key(pod))
+        return None if value is None else END_FORMAT.unpack(value)[0]
+
+    # Record that pods were published, from an iterable of (pod key, end time).
+    def add(self, items):
+        for pod, end in items:
+            self.db[self.key(pod)] = END_FORMAT.pack(end)
+        # Not all dbm implementations have sync(); the others write through or on close.
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+
+    # Remove the pods that ended before the given timestamp, which can no longer be found by the queries. Returns how many were removed.
+    def prune(self, before_ts):
+        old = [key for key in self.db.keys() if END_FORMAT.unpack(self.db[key])[0] < before_ts]
+        for key in old:
+            del self.db[key]
+        return len(old)
+
+    # Number of pods in the index
+    def size(self):
+        return len(self.db)
@@ -0,0 +1,255 @@
+# Run reports, metrics and profiling for KAPEL
+
+import base64
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import resource
+import sys
+import tempfile
+import threading
+import tracemalloc
+from pathlib import Path
+from timeit import default_timer as timer
+
+import requests
+
+# Number of run reports to keep in the reports directory; older ones are deleted.
+REPORTS_KEPT = 100
+
+def now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+# Peak resident memory of the process so far, in bytes (ru_maxrss is in kilobytes on Linux).
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Write a file atomically, so that readers (e.g. the node exporter textfile collector) never see a partial file.
+def write_atomic(path, text):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+# Measurements for one time period. Queries report to it from worker threads, so updates are locked.
+class PeriodReport:
+    def __init__(self, period):
+        self.lock = threading.Lock()
+        self.year = period['year']
+        self.month = period['month']
+        self.instant = period['instant'].isoformat()
+        self.range_sec = period['range_sec']
+        self.status = 'running'
+        self.error = None
+        # name -> {'seconds', 'peak_rss_bytes'}, in the order the phases ran
+        self.phases = {}
+        self.queries = []
+        # record type -> {'records', 'messages', 'bytes', 'write_seconds', 'already_published'}
+        self.output = {}
+
+    # Time a phase of processing the period (e.g. 'query', 'records'). The peak RSS is that of the process at the end of the phase,
+    # so the phase in which it increases is the one responsible for it.
+    @contextlib.contextmanager
+    def phase(self, name):
+        t1 = timer()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = {'seconds': round(timer() - t1, 6), 'peak_rss_bytes': peak_rss()}
+
+    # Record one query: 'request_seconds' is the time until the response started arriving, 'decode_seconds' the time to receive
+    # (if streamed) and decode it, and 'bytes' the size of the uncompressed response body.
+    def add_query(self, name, request_seconds, decode_seconds, bytes, items, **details):
+        with self.lock:
+            self.queries.append({'name': name, 'request_seconds': round(request_seconds, 6), 'decode_seconds': round(decode_seconds, 6),
+                                 'bytes': bytes, 'items': items, **details})
+
+    # Record messages written to the output queue, adding to any already written for the same record type.
+    # 'already_published' is the number of records not written because they were published by a previous run (see PublishedIndex).
+    def add_output(self, record_type, records, messages, bytes, write_seconds, already_published=0):
+        with self.lock:
+            output = self.output.setdefault(record_type, {'records': 0, 'messages': 0, 'bytes': 0, 'write_seconds': 0, 'already_published': 0})
+            output['records'] += records
+            output['messages'] += messages
+            output['bytes'] += bytes
+            output['write_seconds'] = round(output['write_seconds'] + write_seconds, 6)
+            output['already_published'] += already_published
+
+    def to_dict(self):
+        with self.lock:
+            report = dict(vars(self))
+        del report['lock']
+        return report
+
+# Report of a run (or one daemon cycle): what was done for each period and how long it took.
+# It is written as JSON to OUTPUT_PATH/reports, and can be exported as Prometheus metrics.
+class RunReport:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = now()
+        self.finished = None
+        self.periods = []
+        self.skipped = 0
+
+    def period(self, period):
+        report = PeriodReport(period)
+        with self.lock:
+            self.periods.append(report)
+        return report
+
+    def finish(self):
+        self.finished = now()
+
+    def to_dict(self):
+        periods = [p.to_dict() for p in self.periods]
+        queries = [q for p in periods for q in p['queries']]
+        records = {}
+        already_published = 0
+        for p in periods:
+            for record_type, output in p['output'].items():
+                records[record_type] = records.get(record_type, 0) + output['records']
+                already_published += output['already_published']
+        return {
+            'started': self.started.isoformat(),
+            'finished': self.finished.isoformat() if self.finished else None,
+            'seconds': round(((self.finished or now()) - self.started).total_seconds(), 3),
+            'peak_rss_bytes': peak_rss(),
+            'totals': {
+                'periods': {status: sum(1 for p in periods if p['status'] == status) for status in ('completed', 'failed', 'running')},
+                'skipped_periods': self.skipped,
+                'queries': len(queries),
+                'query_seconds': round(sum(q['request_seconds'] + q['decode_seconds'] for q in queries), 3),
+                'query_bytes': sum(q['bytes'] for q in queries),
+                'duplicate_results': sum(q.get('duplicates', 0) for q in queries),
+                'records': records,
+                'already_published': already_published,
+            },
+            'periods': periods,
+        }
+
+    # Write the report to <output_path>/reports/run-<start time>.json, and delete the oldest reports beyond REPORTS_KEPT.
+    # The reports directory is not a dirq queue directory, so ssmsend ignores it.
+    def write(self, output_path):
+        reports = Path(output_path) / 'reports'
+        path = reports / f'run-{self.started.strftime("%Y%m%dT%H%M%S%fZ")}.json'
+        write_atomic(path, json.dumps(self.to_dict(), indent=1))
+        for old in sorted(reports.glob('run-*.json'))[:-REPORTS_KEPT]:
+            old.unlink()
+        print(f'Wrote run report to {path}.')
+        return path
+
+    # Return the metrics of the run in the Prometheus text exposition format. Queries are aggregated by name, and records by type,
+    # to keep the number of series small.
+    # https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+    def prometheus_text(self):
+        report = self.to_dict()
+        queries = {}
+        for p in report['periods']:
+            for q in p['queries']:
+                total = queries.setdefault(q['name'], {'count': 0, 'seconds': 0, 'bytes': 0})
+                total['count'] += 1
+                total['seconds'] += q['request_seconds'] + q['decode_seconds']
+                total['bytes'] += q['bytes']
+        metrics = [
+            ('kapel_run_start_timestamp_seconds', 'gauge', 'Start time of the last KAPEL run.', [({}, self.started.timestamp())]),
+            ('kapel_run_duration_seconds', 'gauge', 'Wall time of the last KAPEL run.', [({}, report['seconds'])]),
+            ('kapel_run_peak_rss_bytes', 'gauge', 'Peak resident memory of the KAPEL process.', [({}, report['peak_rss_bytes'])]),
+            ('kapel_run_periods', 'gauge', 'Number of periods processed by the last run, by status.',
+             [({'status': status}, n) for status, n in report['totals']['periods'].items()]
+             + [({'status': 'skipped'}, report['totals']['skipped_periods'])]),
+            ('kapel_run_queries', 'gauge', 'Number of Prometheus queries run by the last run.',
+             [({'query': name}, total['count']) for name, total in queries.items()]),
+            ('kapel_run_query_seconds', 'gauge', 'Total time of the Prometheus queries of the last run.',
+             [({'query': name}, round(total['seconds'], 6)) for name, total in queries.items()]),
+            ('kapel_run_query_bytes', 'gauge', 'Total size of the Prometheus query responses of the last run.',
+             [({'query': name}, total['bytes']) for name, total in queries.items()]),
+            ('kapel_run_records', 'gauge', 'Number of APEL records written by the last run, by type.',
+             [({'type': record_type}, n) for record_type, n in report['totals']['records'].items()]),
+            ('kapel_run_already_published_records', 'gauge', 'Number of individual job records not written by the last run because they were already published.',
+             [({}, report['totals']['already_published'])]),
+            ('kapel_run_duplicate_results', 'gauge', 'Number of query results for pods that already had a result in the same query in the last run.',
+             [({}, report['totals']['duplicate_results'])]),
+        ]
+        lines = []
+        for name, metric_type, help_text, samples in metrics:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics to a file for the node exporter textfile collector (the file name must end in .prom).
+    def write_textfile(self, path):
+        write_atomic(path, self.prometheus_text())
+        print(f'Wrote run metrics to {path}.')
+
+    # Push the metrics to a Prometheus Pushgateway, grouped by job "kapel" and the given instance name.
+    # https://github.com/prometheus/pushgateway#url
+    def push(self, url, instance):
+        instance = base64.urlsafe_b64encode(instance.encode()).decode()
+        response = requests.put(f'{url.rstrip("/")}/metrics/job/kapel/instance@base64/{instance}', data=self.prometheus_text(), timeout=30)
+        response.raise_for_status()
+        print(f'Pushed run metrics to {url}.')
+
+# Profile everything run within the context with cProfile (in all threads started meanwhile, such as the query workers)
+# and tracemalloc, and write the results to <output_path>/profile:
+# kapel-<time>.pstats (load with pstats or e.g. snakeviz) and kapel-<time>.tracemalloc (a tracemalloc.Snapshot dump).
+# A summary of both is also printed. Both slow down the run considerably.
+# From Python 3.12 (sys.monitoring), a single profiler covers all threads, and only one can be active at a time.
+# Before that, each thread needs its own profiler.
+@contextlib.contextmanager
+def profiled(output_path):
+    profilers = []
+    lock = threading.Lock()
+    per_thread = sys.version_info < (3, 12)
+
+    # threading calls this in each new thread before it runs. Replace it with a profiler for the thread.
+    # Profiling must never stop a thread from running, so a profiler that can't be enabled is skipped.
+    def start_thread_profiler(frame, event, arg):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            print(f'WARNING: not profiling thread {threading.current_thread().name}: {e}')
+            return
+        with lock:
+            profilers.append(profiler)
+
+    tracemalloc.start(10)
+    if per_thread:
+        threading.setprofile(start_thread_profiler)
+    main_profiler = cProfile.Profile()
+    main_profiler.enable()
+    try:
+        yield
+    finally:
+        main_profiler.disable()
+        if per_thread:
+            threading.setprofile(None)
+        snapshot = tracemalloc.take_snapshot()
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profile_dir = Path(output_path) / 'profile'
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        name = f'kapel-{now().strftime("%Y%m%dT%H%M%SZ")}'
+        with lock:
+            stats = pstats.Stats(main_profiler, *profilers)
+        stats.dump_stats(profile_dir / f'{name}.pstats')
+        snapshot.dump(str(profile_dir / f'{name}.tracemalloc'))
+        print(f'Wrote profiles of {len(profilers) + 1 if per_thread else "all"} threads to {profile_dir}/{name}.pstats and {name}.tracemalloc.')
+        stats.sort_stats('cumulative').print_stats(30)
+        print(f'Peak traced memory: {peak_traced} bytes. Top allocations still held at the end of the run:')
+        for stat in snapshot.statistics('lineno')[:15]:
+            print(stat)
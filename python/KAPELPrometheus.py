@@ -0,0 +1,182 @@
+# Prometheus HTTP API access for KAPEL
+
+import codecs
+import json
+import re
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 'status' is the HTTP status code of the response, if there was one, and 'error_type' the errorType reported by Prometheus, if any
+# (e.g. "timeout", "execution", "bad_data"), so that callers can tell which errors are worth retrying.
+# https://prometheus.io/docs/prometheus/latest/querying/api/#format-overview
+class PrometheusQueryError(Exception):
+    def __init__(self, message, status=None, error_type=None):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+
+# Seconds per unit of a Prometheus duration
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'y': 31536000}
+DURATION = re.compile(r'(\d+)(ms|s|m|h|d|w|y)')
+
+# Plain (possibly fractional) seconds, which the HTTP API also accepts for durations such as the query timeout
+SECONDS = re.compile(r'\d+(\.\d+)?')
+
+# Return the number of seconds of a Prometheus duration such as "1800s" or "1h30m", or a number of seconds such as "1800".
+# https://prometheus.io/docs/prometheus/latest/querying/basics/#time-durations
+# https://prometheus.io/docs/prometheus/latest/querying/api/#format-overview
+def parse_duration(duration):
+    if SECONDS.fullmatch(duration):
+        return float(duration)
+    parts = DURATION.findall(duration)
+    if not parts or ''.join(number + unit for number, unit in parts) != duration:
+        raise ValueError(f'Invalid duration: {duration!r}')
+    return sum(int(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+# How long to wait for a connection to Prometheus, and how much longer than the query timeout to wait for a response
+# before giving up on it (e.g. if the query is stuck behind others), in seconds.
+CONNECT_TIMEOUT = 30
+RESPONSE_MARGIN = 60
+
+# Matches the key of the result list in a query response, but not 'resultType'.
+RESULT_KEY = re.compile(r'"result"\s*:\s*\[')
+WHITESPACE = re.compile(r'[\s,]*')
+
+# Incrementally parse the body of a Prometheus query response, given as an iterable of byte chunks.
+# Yields each element of data.result (a dict with 'metric' and 'value' or 'values') as soon as it has been received,
+# so that only one element needs to be held in memory at a time, instead of the whole decoded response.
+# See https://prometheus.io/docs/prometheus/latest/querying/api/#format-overview
+def iter_results(chunks):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buf, pos, eof
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+            buf = buf[pos:] + text_decoder.decode(b'', final=True)
+        else:
+            buf = buf[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+    # Read until the start of the result list. Everything before it is small (status and resultType).
+    while True:
+        match = RESULT_KEY.search(buf)
+        if match:
+            break
+        if eof:
+            # Not a successful query response, so it must be small enough to decode as a whole.
+            try:
+                body = json.loads(buf)
+            except ValueError:
+                raise PrometheusQueryError(f'Invalid response from Prometheus: {buf[:1000]}')
+            raise PrometheusQueryError(f'Query failed: {body.get("errorType")}: {body.get("error")}', error_type=body.get('errorType'))
+        # Keep the whole prefix, since the key may be split across chunks.
+        read_more()
+    if not re.search(r'"status"\s*:\s*"success"', buf[:match.start()]):
+        raise PrometheusQueryError(f'Unexpected response from Prometheus: {buf[:1000]}')
+    pos = match.end()
+
+    # Decode each element of the list in turn, reading more of the response whenever an element is incomplete.
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise PrometheusQueryError('Truncated or invalid response from Prometheus', error_type='truncated')
+            read_more()
+            continue
+        pos = end
+        yield item
+
+# Pass through an iterable of byte chunks, adding up their size in stats['bytes'].
+def count_bytes(chunks, stats):
+    stats['bytes'] = 0
+    for chunk in chunks:
+        stats['bytes'] += len(chunk)
+        yield chunk
+
+# Minimal client for the Prometheus instant and range query APIs, replacing prometheus_api_client (which pulls in pandas, numpy, matplotlib etc.)
+# Connections are kept alive and pooled by the requests session, so the client should be created once and reused, including from
+# multiple threads. Responses are gzip-compressed by Prometheus and decompressed transparently.
+# Failed connections and 502/504 responses (from a proxy in front of Prometheus) are retried 'retries' times with exponential backoff
+# (1 s, 2 s, 4 s, ...). Other errors, including 503 responses for queries that timed out and responses that take too long to arrive,
+# are raised, so that the caller can decide whether to run the query again as it is (see KAPELScheduler).
+class PrometheusClient:
+    def __init__(self, url, headers=None, verify=True, retries=3, pool_size=10, chunk_size=65536):
+        self.url = url.rstrip('/')
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.headers.update({'Accept-Encoding': 'gzip'})
+        if headers:
+            self.session.headers.update(headers)
+        retry = Retry(total=retries, read=0, backoff_factor=1, status_forcelist=(502, 504),
+                      allowed_methods=('GET',), raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _get(self, path, params, stream):
+        # Docs on the query API: https://prometheus.io/docs/prometheus/latest/querying/api/#expression-queries
+        timeout = (CONNECT_TIMEOUT, parse_duration(params['timeout']) + RESPONSE_MARGIN) if 'timeout' in params else None
+        response = self.session.get(f'{self.url}{path}', params=params, stream=stream, timeout=timeout)
+        if response.status_code != 200:
+            content = response.text
+            response.close()
+            try:
+                error_type = json.loads(content).get('errorType')
+            except (ValueError, AttributeError):
+                error_type = None
+            raise PrometheusQueryError(f'HTTP status code {response.status_code}: {content[:1000]}', status=response.status_code, error_type=error_type)
+        return response
+
+    def _result(self, response, stats):
+        if stats is not None:
+            stats['bytes'] = len(response.content)
+        body = response.json()
+        if body.get('status') != 'success':
+            raise PrometheusQueryError(f'Query failed: {body.get("errorType")}: {body.get("error")}', error_type=body.get('errorType'))
+        return body['data']['result']
+
+    # Run an instant query and return the list of elements of the result, like prometheus_api_client's custom_query.
+    # https://prometheus.io/docs/prometheus/latest/querying/api/#instant-queries
+    # If a 'stats' dict is given, the size of the (uncompressed) response body is stored in stats['bytes'].
+    def custom_query(self, query, params=None, stats=None):
+        return self._result(self._get('/api/v1/query', {'query': query, **(params or {})}, stream=False), stats)
+
+    # Run an instant query, returning a generator over the elements of the result, which are decoded as the response is received.
+    # If a 'stats' dict is given, stats['bytes'] counts the size of the response body received so far.
+    def stream_query(self, query, params=None, stats=None):
+        return self._iter_response(self._get('/api/v1/query', {'query': query, **(params or {})}, stream=True), stats)
+
+    # Run a range query evaluated every 'step' seconds from start_time to end_time (datetimes), and return the list of elements
+    # of the result, each with a list of [timestamp, value] pairs under 'values', like prometheus_api_client's custom_query_range.
+    # https://prometheus.io/docs/prometheus/latest/querying/api/#range-queries
+    def custom_query_range(self, query, start_time, end_time, step, params=None, stats=None):
+        return self._result(self._get('/api/v1/query_range', self._range_params(query, start_time, end_time, step, params), stream=False), stats)
+
+    # Run a range query, returning a generator over the elements of the result, which are decoded as the response is received.
+    def stream_query_range(self, query, start_time, end_time, step, params=None, stats=None):
+        return self._iter_response(self._get('/api/v1/query_range', self._range_params(query, start_time, end_time, step, params), stream=True), stats)
+
+    def _range_params(self, query, start_time, end_time, step, params):
+        return {'query': query, 'start': start_time.timestamp(), 'end': end_time.timestamp(), 'step': step, **(params or {})}
+
+    def _iter_response(self, response, stats):
+        with response:
+            chunks = response.iter_content(chunk_size=self.chunk_size)
+            if stats is not None:
+                chunks = count_bytes(chunks, stats)
+            yield from iter_results(chunks)
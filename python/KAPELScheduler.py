@@ -0,0 +1,162 @@
+# Adaptive timeouts, retries and splitting of Prometheus queries for KAPEL
+
+import datetime
+import json
+import math
+import threading
+import time
+from pathlib import Path
+from timeit import default_timer as timer
+
+import requests
+
+from KAPELMetrics import write_atomic
+from KAPELPrometheus import PrometheusQueryError
+
+# Prometheus error types that may succeed if the same query is run again later, when Prometheus is less busy.
+# 'truncated' is a response that ended early, e.g. because the connection was closed.
+RETRY_ERROR_TYPES = ('timeout', 'canceled', 'unavailable', 'internal', 'truncated')
+# Error types that may succeed for a query over a shorter time range. 'execution' includes loading too many samples.
+SPLIT_ERROR_TYPES = RETRY_ERROR_TYPES + ('execution',)
+
+# Return whether an exception from running a query is worth retrying as it is, and whether it might not happen for a shorter time range.
+def retryable(e):
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    return isinstance(e, PrometheusQueryError) and ((e.status or 0) >= 500 or e.error_type in RETRY_ERROR_TYPES)
+
+def splittable(e):
+    return retryable(e) or (isinstance(e, PrometheusQueryError) and e.error_type in SPLIT_ERROR_TYPES)
+
+def timed_out(e):
+    return isinstance(e, requests.exceptions.Timeout) or (isinstance(e, PrometheusQueryError) and e.error_type == 'timeout')
+
+# Latency of each kind of query in previous runs, as seconds per second of the time range queried, which is roughly how query time
+# scales since Prometheus has to load the samples of the whole range. It is kept as an exponentially weighted moving average,
+# so that it follows gradual changes in the size of the cluster and the load on Prometheus, and saved as JSON between runs.
+class QueryHistory:
+    # Weight of each new measurement in the moving average
+    ALPHA = 0.3
+    # Shorter ranges are counted as this long, since the time of short queries is mostly overhead rather than loading samples
+    MIN_RANGE_SEC = 3600
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.lock = threading.Lock()
+        # key -> {'rate', 'queries', 'updated'}
+        self.entries = {}
+        if self.path and self.path.exists():
+            try:
+                self.entries = json.loads(self.path.read_text())['queries']
+            except (OSError, ValueError, KeyError) as e:
+                print(f'WARNING: ignoring unreadable query history {self.path}: {e}')
+
+    # Record that a query over 'range_sec' seconds took 'seconds' (or at least that long, if it timed out).
+    def add(self, key, range_sec, seconds):
+        rate = seconds / max(range_sec, self.MIN_RANGE_SEC)
+        with self.lock:
+            entry = self.entries.setdefault(key, {'rate': rate, 'queries': 0})
+            entry['rate'] = self.ALPHA * rate + (1 - self.ALPHA) * entry['rate']
+            entry['queries'] += 1
+            entry['updated'] = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+
+    # Return the expected time of a query over 'range_sec' seconds, or None if there is no history for it.
+    def predict(self, key, range_sec):
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry['rate'] * max(range_sec, self.MIN_RANGE_SEC) if entry else None
+
+    def save(self):
+        if self.path:
+            with self.lock:
+                text = json.dumps({'queries': self.entries}, indent=1)
+            write_atomic(self.path, text)
+
+# Runs queries with timeouts based on the QueryHistory, retries those that fail with errors that may be temporary (with exponential
+# backoff and a longer timeout each time), and if they still fail, splits the time range in half and queries each half separately.
+# This lets a run finish when Prometheus is busy, instead of failing on the first slow query or waiting for the maximum timeout.
+# Without a history, every query gets the maximum timeout, and it can't choose shard sizes.
+# If budget_sec is set, each query (including its retries and the queries of the halves it is split into) is given up after that long.
+class QueryScheduler:
+    # Timeouts are this many times the expected time of the query, but at least MIN_TIMEOUT_SEC seconds
+    TIMEOUT_FACTOR = 4
+    MIN_TIMEOUT_SEC = 60
+    # Shards are sized so that each query is expected to take at most this fraction of the maximum timeout
+    SHARD_TARGET_FRACTION = 0.25
+
+    def __init__(self, max_timeout_sec, retries=0, backoff_sec=0, split_min_sec=0, history=None, budget_sec=0):
+        # Timeouts are passed to Prometheus as whole seconds
+        self.max_timeout_sec = math.ceil(max_timeout_sec)
+        self.retries = retries
+        self.backoff_sec = backoff_sec
+        self.split_min_sec = split_min_sec
+        self.history = history
+        self.budget_sec = budget_sec
+
+    # Return the timeout in seconds for a query over 'range_sec' seconds.
+    def timeout(self, key, range_sec):
+        expected = self.history.predict(key, range_sec) if self.history else None
+        if expected is None:
+            return self.max_timeout_sec
+        return math.ceil(min(self.max_timeout_sec, max(self.MIN_TIMEOUT_SEC, self.TIMEOUT_FACTOR * expected)))
+
+    # Return the shard size in seconds such that each of the given queries is expected to take no more than a fraction of
+    # the maximum timeout, as a whole number of hours, or None if the whole range can be queried at once (or there is no history).
+    def shard_sec(self, keys, range_sec):
+        if not self.history:
+            return None
+        expected = max((self.history.predict(key, range_sec) or 0 for key in keys), default=0)
+        target = self.max_timeout_sec * self.SHARD_TARGET_FRACTION
+        if expected <= target:
+            return None
+        shard_sec = math.ceil(range_sec / math.ceil(expected / target) / 3600) * 3600
+        return max(shard_sec, self.split_min_sec, 3600)
+
+    # Return the deadline (a timer() value) of a query started now, or None if there is no budget.
+    def deadline(self):
+        return timer() + self.budget_sec if self.budget_sec else None
+
+    # Run a query over 'range_sec' seconds, calling attempt(timeout in seconds) to run it once and return its results.
+    # If it fails with an error that may be temporary, it is retried up to 'retries' times. If it still fails (or fails with an error
+    # that may be due to the size of the range), split(deadline) is called to query the range in two halves by the same deadline,
+    # and return the combined results, as long as the range is at least twice split_min_sec (and split_min_sec is not 0).
+    # Otherwise the last error is raised. A query that can be split is not retried after timing out with the maximum timeout,
+    # since it would most likely time out again, but a query that can't be split is, since the timeout may have been temporary.
+    # 'deadline' is that of the query this is part of, if any; otherwise the query gets its own deadline from budget_sec.
+    def run(self, key, range_sec, attempt, split=None, deadline=None):
+        deadline = deadline or self.deadline()
+        timeout = self.timeout(key, range_sec)
+        can_split = bool(split and self.split_min_sec and range_sec >= 2 * self.split_min_sec)
+        for n in range(self.retries + 1):
+            if deadline:
+                remaining = math.floor(deadline - timer())
+                if remaining < 1:
+                    raise TimeoutError(f'{key} query over {range_sec} s was not completed within the time budget of {self.budget_sec} s')
+                timeout = min(timeout, remaining)
+            t1 = timer()
+            try:
+                result = attempt(timeout)
+            except Exception as e:
+                if not splittable(e):
+                    raise
+                seconds = timer() - t1
+                if timed_out(e) and self.history:
+                    self.history.add(key, range_sec, seconds)
+                error = e
+                if not retryable(e) or n == self.retries or (can_split and timed_out(e) and timeout >= self.max_timeout_sec):
+                    break
+                delay = self.backoff_sec * 2 ** n
+                if deadline:
+                    delay = max(0, min(delay, deadline - timer()))
+                print(f'WARNING: {key} query over {range_sec} s failed after {seconds:.1f} s with timeout {timeout} s: {type(e).__name__}: {e}. '
+                      f'Retrying in {delay:.0f} s ({n + 1}/{self.retries}).')
+                time.sleep(delay)
+                timeout = min(self.max_timeout_sec, timeout * 2)
+                continue
+            if self.history:
+                self.history.add(key, range_sec, timer() - t1)
+            return result
+        if can_split:
+            print(f'WARNING: {key} query over {range_sec} s failed: {type(error).__name__}: {error}. Splitting it in two halves.')
+            return split(deadline)
+        raise error
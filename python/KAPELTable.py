@@ -0,0 +1,96 @@
+# Compact per-pod storage of query results for KAPEL
+
+import math
+import sys
+from array import array
+
+NAN = float('nan')
+
+# Holds the results of all queries for a time period in columnar form: a single index of pods,
+# and one array of floats per query, aligned with the index. Values that a query did not return for a pod are NaN.
+# Pods are identified by a tuple of label values, e.g. (namespace, pod name).
+# Compared to a dict of {pod: value} per query, this stores each pod key once and each value as a plain 8-byte float.
+class PodTable:
+    def __init__(self):
+        # row number -> pod key
+        self.pods = []
+        # pod key -> row number
+        self.index = {}
+        # column (query) name -> array of values, created when the first results for that query are merged
+        self.columns = {}
+        # Results of queries with several series per pod (e.g. one per container), keyed by the pod key followed by the labels
+        # of each series, in a PodTable of their own so that they don't add rows to this one. Created by series_table.
+        self.series = None
+
+    def __len__(self):
+        return len(self.pods)
+
+    # Return the row number of a pod, adding a row of NaNs if the pod is new.
+    def row(self, pod):
+        row = self.index.get(pod)
+        if row is None:
+            row = len(self.pods)
+            pod = tuple(map(sys.intern, pod))
+            self.pods.append(pod)
+            self.index[pod] = row
+            for column in self.columns.values():
+                column.append(NAN)
+        return row
+
+    # Merge (pod, value) pairs into a column, keeping the largest value of each pod.
+    # Since NaN compares false with everything, a missing value is always replaced.
+    def merge_max(self, name, items):
+        column = self.column(name)
+        for pod, value in items:
+            row = self.row(pod)
+            if not column[row] >= value:
+                column[row] = value
+
+    # Return the array of values of a column, creating it (filled with NaN) if no results have been merged into it.
+    def column(self, name):
+        if name not in self.columns:
+            self.columns[name] = array('d', [NAN]) * len(self.pods)
+        return self.columns[name]
+
+    # Return the PodTable of per-series results, creating it if needed.
+    def series_table(self):
+        if self.series is None:
+            self.series = PodTable()
+        return self.series
+
+    # Return the value of a column for a row, or 'default' if it is missing.
+    def get(self, name, row, default=None):
+        if name not in self.columns:
+            return default
+        value = self.columns[name][row]
+        return default if math.isnan(value) else value
+
+    # Return a table sharing the pod index, columns and per-series results of this one, except for the given columns, which are replaced.
+    # Used to derive columns for output without modifying a table that is also held in the cache.
+    def replace(self, **columns):
+        table = PodTable()
+        table.pods = self.pods
+        table.index = self.index
+        table.columns = {**self.columns, **columns}
+        table.series = self.series
+        return table
+
+    # Convert to and from plain lists, e.g. for JSON serialization. NaN is kept as is. The per-series results are included.
+    def to_dict(self):
+        data = {'pods': self.pods, 'columns': {name: column.tolist() for name, column in self.columns.items()}}
+        if self.series is not None:
+            data['series'] = self.series.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        table = cls()
+        for pod in data['pods']:
+            # JSON turns the key tuples into lists
+            table.row(tuple(pod))
+        for name, values in data['columns'].items():
+            assert len(values) == len(table.pods), f'column {name} does not match the pod index'
+            table.columns[name] = array('d', values)
+        if 'series' in data:
+            table.series = cls.from_dict(data['series'])
+        return table